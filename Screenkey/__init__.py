@@ -46,6 +46,43 @@ MODS_MODES = {
     'tux': _('Linux'),
 }
 
+COMPOSE_ENGINES = {
+    'xim': _('Input method'),
+    'table': _('Compose table'),
+}
+
+TRANSLATORS = {
+    'xlib': _('Xlib'),
+    'xkbcommon': _('libxkbcommon'),
+}
+
+RELAY_MODES = {
+    'server': _('Server'),
+    'local': _('Local'),
+}
+
+CAPTURE_BACKENDS = {
+    'record': _('XRecord'),
+    'xi2': _('XInput2'),
+}
+
+LOOP_MODES = {
+    'thread': _('Listener thread'),
+    'glib': _('Main loop'),
+    'process': _('Listener process'),
+}
+
+OVERLOAD_POLICIES = {
+    'drop': _('Drop oldest'),
+    'collapse': _('Collapse repeats'),
+    'summarize': _('Summarize'),
+}
+
+RENDER_POLICIES = {
+    'latency': _('Latency first'),
+    'throughput': _('Throughput first'),
+}
+
 class Options(dict):
     def __getattr__(self, k):
         return self[k]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+#
+# Capture files contain the raw wire events intercepted by XRecord, in order
+# to reproduce problems without the original input. The file is append-only:
+# a fixed header is followed by fixed-size records, each containing the
+# monotonic time of reception (in seconds) and the 32-byte wire event. Focus
+# changes are recorded as regular wire events. The data is stored in native
+# byte order, as is the protocol data we can handle.
+
+from __future__ import unicode_literals, absolute_import
+
+from ctypes import c_ubyte, string_at
+import mmap
+import os
+import struct
+
+
+MAGIC = b'SKCAPT\0\1'
+BYTE_ORDER = 0x01020304
+WIRE_SIZE = 32
+
+HEADER = struct.Struct(str('=8sI'))
+RECORD = struct.Struct(str('=d{}s'.format(WIRE_SIZE)))
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureWriter(object):
+    def __init__(self, path):
+        self.fd = open(path, 'ab')
+        if self.fd.tell() == 0:
+            self.fd.write(HEADER.pack(MAGIC, BYTE_ORDER))
+        else:
+            with open(path, 'rb') as fd:
+                _check_header(fd.read(HEADER.size))
+
+
+    def write(self, stamp, data):
+        self.fd.write(RECORD.pack(stamp, string_at(data, WIRE_SIZE)))
+
+
+    def close(self):
+        self.fd.close()
+
+
+
+class CaptureReader(object):
+    def __init__(self, path):
+        self.fd = open(path, 'rb')
+        size = os.fstat(self.fd.fileno()).st_size
+        _check_header(self.fd.read(HEADER.size))
+        self.count = (size - HEADER.size) // RECORD.size
+        if self.count:
+            self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = None
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        ofs = HEADER.size + i * RECORD.size
+        stamp, = struct.unpack_from(str('=d'), self.map, ofs)
+        data = (c_ubyte * WIRE_SIZE).from_buffer_copy(self.map, ofs + RECORD.size - WIRE_SIZE)
+        return stamp, data
+
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.fd.close()
+
+
+
+def _check_header(buf):
+    if len(buf) != HEADER.size:
+        raise CaptureError("truncated capture file")
+    magic, byte_order = HEADER.unpack(buf)
+    if magic != MAGIC:
+        raise CaptureError("not a capture file")
+    if byte_order != BYTE_ORDER:
+        raise CaptureError("capture file has a different byte order")
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+#
+# In-process compose sequences, as an alternative to relaying events through
+# XIM. The Compose tables are looked up the same way as libX11 does
+# ($XCOMPOSEFILE, ~/.XCompose or the table of the current locale) and
+# compiled into a trie of keysyms. Leaves contain the resulting string and
+# keysym. The compiled trie is cached as JSON in the user cache directory,
+# and rebuilt when any of the source files changes.
+
+from __future__ import unicode_literals, absolute_import
+
+if '.' not in __name__:
+    # imported by inputlistener running as a script
+    import xlib
+else:
+    from . import xlib
+
+import sys
+if sys.version_info.major < 3:
+    import glib
+else:
+    from gi.repository import GLib as glib
+
+import io
+import json
+import locale
+import os
+import re
+import warnings
+
+
+SYSTEM_DIR = '/usr/share/X11/locale'
+CACHE_DIR = os.path.join(glib.get_user_cache_dir(), 'screenkey')
+CACHE_VERSION = 2
+MAX_INCLUDE_DEPTH = 8
+
+_RE_INCLUDE = re.compile(r'^\s*include\s+"((?:[^"\\]|\\.)*)"')
+_RE_SEQUENCE = re.compile(r'^\s*((?:<[^>\s]+>\s*)+):\s*(?:"((?:[^"\\]|\\.)*)")?\s*([A-Za-z0-9_]+)?')
+_RE_KEYSYM = re.compile(r'<([^>\s]+)>')
+_RE_ESCAPE = re.compile(r'\\([0-7]{1,3}|[xX][0-9a-fA-F]{1,2}|.)')
+
+
+def is_modifier(keysym):
+    # equivalent of the IsModifierKey macro
+    return (0xffe1 <= keysym <= 0xffee or   # Shift_L ... Hyper_R
+            0xfe01 <= keysym <= 0xfe13 or   # ISO_Lock ... ISO_Level5_Lock
+            keysym in (0xff7e, 0xff7f))     # Mode_switch, Num_Lock
+
+
+def _unescape(string):
+    # octal and hex escapes are bytes: consecutive ones form UTF-8 sequences
+    parts = []
+    raw = bytearray()
+    pos = 0
+    for m in _RE_ESCAPE.finditer(string):
+        c = m.group(1)
+        if m.start() != pos or not (c[0] in '01234567' or (c[0] in 'xX' and len(c) > 1)):
+            if raw:
+                parts.append(bytes(raw).decode('utf-8', 'replace'))
+                raw = bytearray()
+            parts.append(string[pos:m.start()])
+        pos = m.end()
+        if c[0] in '01234567':
+            raw.append(int(c, 8) & 0xff)
+        elif c[0] in 'xX' and len(c) > 1:
+            raw.append(int(c[1:], 16))
+        elif c == 'n':
+            parts.append('\n')
+        else:
+            parts.append(c)
+    if raw:
+        parts.append(bytes(raw).decode('utf-8', 'replace'))
+    parts.append(string[pos:])
+    return ''.join(parts)
+
+
+def _read_table(path):
+    # "key value" pairs of compose.dir and locale.alias
+    ret = []
+    try:
+        with io.open(path, encoding='utf-8', errors='replace') as fd:
+            for line in fd:
+                line = line.split('#', 1)[0].split()
+                if len(line) >= 2:
+                    ret.append((line[0].rstrip(':'), line[1]))
+    except IOError:
+        pass
+    return ret
+
+
+def current_locale():
+    name = locale.setlocale(locale.LC_CTYPE)
+    if name in ['C', 'POSIX']:
+        for var in ['LC_ALL', 'LC_CTYPE', 'LANG']:
+            if os.environ.get(var):
+                name = os.environ[var]
+                break
+    return name
+
+
+def system_table(name):
+    """Path of the system Compose table for the locale name"""
+    for alias, target in _read_table(os.path.join(SYSTEM_DIR, 'locale.alias')):
+        if alias == name:
+            name = target
+            break
+    for path, target in _read_table(os.path.join(SYSTEM_DIR, 'compose.dir')):
+        if target == name:
+            return os.path.join(SYSTEM_DIR, path)
+    return None
+
+
+def user_table():
+    path = os.environ.get('XCOMPOSEFILE')
+    if path:
+        return path
+    path = os.path.expanduser('~/.XCompose')
+    if os.path.exists(path):
+        return path
+    return None
+
+
+def _substitute(path, name):
+    ret = ''
+    i = 0
+    while i < len(path):
+        if path[i] == '%' and i + 1 < len(path):
+            c = path[i + 1]
+            if c == 'H':
+                ret += os.path.expanduser('~')
+            elif c == 'L':
+                ret += system_table(name) or ''
+            elif c == 'S':
+                ret += SYSTEM_DIR
+            else:
+                ret += c
+            i += 2
+        else:
+            ret += path[i]
+            i += 1
+    return ret
+
+
+def _parse(path, name, trie, sources, depth=0):
+    try:
+        fd = io.open(path, encoding='utf-8', errors='replace')
+    except IOError as e:
+        warnings.warn("cannot read compose table {}: {}".format(path, e))
+        return
+    st = os.fstat(fd.fileno())
+    sources.append([path, st.st_mtime, st.st_size])
+    with fd:
+        for line in fd:
+            m = _RE_INCLUDE.match(line)
+            if m is not None:
+                if depth < MAX_INCLUDE_DEPTH:
+                    sub = _substitute(_unescape(m.group(1)), name)
+                    _parse(sub, name, trie, sources, depth + 1)
+                continue
+            m = _RE_SEQUENCE.match(line)
+            if m is None:
+                continue
+            seq = [xlib.XStringToKeysym(x.encode('ascii'))
+                   for x in _RE_KEYSYM.findall(m.group(1))]
+            if not all(seq):
+                continue
+            string = _unescape(m.group(2)) if m.group(2) is not None else ''
+            keysym = xlib.XStringToKeysym(m.group(3).encode('ascii')) if m.group(3) else 0
+            if not string and not keysym:
+                continue
+
+            # later definitions replace earlier ones
+            node = trie
+            for sym in seq[:-1]:
+                child = node.get(sym)
+                if not isinstance(child, dict):
+                    child = node[sym] = {}
+                node = child
+            node[seq[-1]] = [string, keysym]
+
+
+def compile_table(name):
+    """Compile the Compose table for the locale name, returning the trie and
+    the list of source files"""
+    trie = {}
+    sources = []
+    path = user_table() or system_table(name)
+    if path is not None:
+        _parse(path, name, trie, sources)
+    return trie, sources
+
+
+def _keysym_keys(pairs):
+    # JSON object keys are strings: restore the keysyms of the trie
+    return {int(k) if k.isdigit() else k: v for k, v in pairs}
+
+
+def _cache_valid(sources):
+    for path, mtime, size in sources:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_mtime != mtime or st.st_size != size:
+            return False
+    return True
+
+
+def load_table(name=None):
+    """Return the compiled Compose trie for the locale name (default: current
+    locale), using the cached copy when still valid"""
+    if name is None:
+        name = current_locale()
+    if name in ['C', 'POSIX']:
+        name = 'en_US.UTF-8'
+    cache = os.path.join(CACHE_DIR, 'compose-{}.json'.format(
+        re.sub(r'[^A-Za-z0-9_.@-]', '_', name)))
+    table = user_table() or system_table(name)
+
+    try:
+        with open(cache) as fd:
+            data = json.load(fd, object_pairs_hook=_keysym_keys)
+        if data['version'] == CACHE_VERSION and data['table'] == table and \
+           _cache_valid(data['sources']):
+            return data['trie']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    trie, sources = compile_table(name)
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp = cache + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump({'version': CACHE_VERSION, 'table': table,
+                       'sources': sources, 'trie': trie}, fd)
+        os.rename(tmp, cache)
+    except (IOError, OSError) as e:
+        warnings.warn("cannot write compose cache {}: {}".format(cache, e))
+    return trie
+
+
+
+class Composer(object):
+    """Compose state machine over a compiled trie"""
+
+    def __init__(self, trie):
+        self.trie = trie
+        self.node = None
+
+
+    def reset(self):
+        self.node = None
+
+
+    def feed(self, keysym):
+        """Feed a pressed keysym. Returns None when the key is not part of a
+        sequence, True when it was consumed (including the key interrupting
+        a sequence, as XIM does), or the [string, keysym] of a completed
+        sequence."""
+        if is_modifier(keysym):
+            return None if self.node is None else True
+        node = self.trie if self.node is None else self.node
+        child = node.get(keysym)
+        if child is None:
+            if self.node is None:
+                return None
+            self.node = None
+            return True
+        if isinstance(child, dict):
+            self.node = child
+            return True
+        self.node = None
+        return child
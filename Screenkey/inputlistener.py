@@ -37,9 +37,21 @@ from __future__ import unicode_literals, absolute_import
 if __name__ == '__main__':
     import xlib
     import keysyms
+    from capture import CaptureReader, CaptureWriter
+    from compose import Composer, load_table
+    from ring import Ring
+    import xkbcommon
+    from stats import stats
+    from timer import ServerClock, monotonic
 else:
     from . import xlib
     from . import keysyms
+    from .capture import CaptureReader, CaptureWriter
+    from .compose import Composer, load_table
+    from .ring import Ring
+    from . import xkbcommon
+    from .stats import stats
+    from .timer import ServerClock, monotonic
 
 import sys
 if sys.version_info.major < 3:
@@ -47,6 +59,13 @@ if sys.version_info.major < 3:
 else:
     from gi.repository import GLib as glib
 
+from collections import deque, namedtuple
+import errno
+import fcntl
+import math
+import os
+import signal
+import struct
 import threading
 import warnings
 import select
@@ -91,15 +110,18 @@ def record_context(dpy, ev_ranges, dev_ranges):
     return rec_ctx
 
 
-def record_enable(dpy, rec_ctx, callback):
+def record_enable(dpy, rec_ctx, callback, capture=None):
+    decoder = xlib.WireDecoder(dpy)
+
     def intercept(data):
         if data.category != xlib.XRecordFromServer:
             return
         if data.client_swapped:
             warnings.warn("cannot handle swapped protocol data")
             return
-        ev = xlib.XWireToEvent(dpy, data.data)
-        callback(ev)
+        if capture is not None:
+            capture.write(monotonic(), data.data)
+        callback(decoder.decode(data.data))
 
     def intercept_(_, data):
         intercept(data.contents)
@@ -110,6 +132,25 @@ def record_enable(dpy, rec_ctx, callback):
     return proc
 
 
+def xi2_select(dpy, win, evtypes, devices):
+    mask_len = (xlib.XI_LASTEVENT >> 3) + 1
+    masks = (xlib.XIEventMask * len(devices))()
+    bufs = []
+    for i, device in enumerate(devices):
+        buf = (xlib.c_ubyte * mask_len)()
+        for evtype in evtypes:
+            buf[evtype >> 3] |= 1 << (evtype & 7)
+        bufs.append(buf)
+        masks[i].deviceid = device
+        masks[i].mask_len = mask_len
+        masks[i].mask = xlib.cast(buf, xlib.POINTER(xlib.c_ubyte))
+    return xlib.XISelectEvents(dpy, win, masks, len(devices))
+
+
+def set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
 def create_replay_window(dpy):
     win_attr = xlib.XSetWindowAttributes()
     win_attr.override_redirect = True
@@ -121,12 +162,10 @@ def create_replay_window(dpy):
     return win
 
 
-def phantom_release(dpy, kev):
-    if not xlib.XPending(dpy):
-        return False
-    ev = xlib.XEvent()
-    xlib.XPeekEvent(dpy, xlib.byref(ev))
-    return (ev.type == xlib.KeyPress and \
+def phantom_release(ev, kev):
+    # ev is the event following the release, if any
+    return (ev is not None and \
+            ev.type == xlib.KeyPress and \
             ev.xkey.state == kev.state and \
             ev.xkey.keycode == kev.keycode and \
             ev.xkey.time == kev.time)
@@ -141,20 +180,224 @@ def keysym_to_unicode(keysym):
     return None
 
 
+class KeyboardMap(object):
+    # Keycode to keysym table, fetched with a single request and refreshed on
+    # mapping changes only. Each row contains the keysyms of a keycode in core
+    # protocol order (group 1 level 1-2, group 2 level 1-2, ...). Keysym names
+    # are cached alongside.
+    def __init__(self, dpy):
+        self.dpy = dpy
+        self.table = []
+        self.names = {}
+        self.refresh()
+
+
+    def refresh(self):
+        min_keycode = xlib.c_int()
+        max_keycode = xlib.c_int()
+        xlib.XDisplayKeycodes(self.dpy, xlib.byref(min_keycode), xlib.byref(max_keycode))
+        count = max_keycode.value - min_keycode.value + 1
+        per_keycode = xlib.c_int()
+        syms = xlib.XGetKeyboardMapping(self.dpy, min_keycode.value, count,
+                                        xlib.byref(per_keycode))
+        table = [()] * 256
+        if syms:
+            n = per_keycode.value
+            for i in range(count):
+                table[min_keycode.value + i] = tuple(syms[i * n:(i + 1) * n])
+            xlib.XFree(syms)
+        self.table = table
+        self.names.clear()
+
+
+    def keysym(self, keycode, group=0, level=0):
+        row = self.table[keycode]
+        i = group * 2 + level
+        return row[i] if i < len(row) else xlib.NoSymbol
+
+
+    def name(self, keysym):
+        try:
+            return self.names[keysym]
+        except KeyError:
+            name = self.names[keysym] = xlib.XKeysymToString(keysym)
+            return name
+
+
+
+# Modifier state: decoded once for each mask and shared by all events
+MODIFIER_MASKS = [('shift', xlib.ShiftMask),
+                  ('caps_lock', xlib.LockMask),
+                  ('ctrl', xlib.ControlMask),
+                  ('alt', xlib.Mod1Mask),
+                  ('num_lock', xlib.Mod2Mask),
+                  ('hyper', xlib.Mod3Mask),
+                  ('super', xlib.Mod4Mask),
+                  ('alt_gr', xlib.Mod5Mask)]
+
+MODIFIER_INDEX = {name: i for i, (name, _) in enumerate(MODIFIER_MASKS)}
+
+class Modifiers(namedtuple('Modifiers', [name for name, _ in MODIFIER_MASKS])):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        # allow lookups by name, as with the former dict
+        return tuple.__getitem__(self, MODIFIER_INDEX.get(key, key))
+
+MODIFIERS_MASK = 0xff
+MODIFIERS = tuple(Modifiers._make(bool(state & mask) for _, mask in MODIFIER_MASKS)
+                  for state in range(MODIFIERS_MASK + 1))
+
+
+
+# Stage timestamps:
+#
+# time:       X server time (ms)
+# received:   reception from XRecord (local monotonic time, in seconds)
+# processed:  end of processing in the listener
+# dispatched: reception in the main loop
+#
+# device is the id of the source device (XInput2 capture only)
+#
+# skipped is the number of key presses discarded before this event when the
+# queue overflows in "summarize" mode
+#
+# count is the number of identical autorepeat events merged into this one
+#
+# pressed, filtered and repeated are stored as KEY_* bits in flags
+
+KEY_PRESSED  = 0b000001
+KEY_FILTERED = 0b000010
+KEY_REPEATED = 0b000100
+
+
+def _flag_property(bit):
+    def get(self):
+        return bool(self.flags & bit)
+    def set(self, value):
+        if value:
+            self.flags |= bit
+        else:
+            self.flags &= ~bit
+    return property(get, set)
+
+
+class KeyData(object):
+    __slots__ = ('flags', 'string', 'keysym', 'status', 'symbol', 'mods_mask', 'modifiers',
+                 'time', 'received', 'processed', 'dispatched', 'device', 'skipped', 'count')
 
-class KeyData():
     def __init__(self, pressed=None, filtered=None, repeated=None,
                  string=None, keysym=None, status=None, symbol=None,
-                 mods_mask=None, modifiers=None):
-        self.pressed = pressed
-        self.filtered = filtered
-        self.repeated = repeated
+                 mods_mask=None, modifiers=None, time=None, received=None,
+                 processed=None, dispatched=None, device=None, skipped=0, count=1):
+        self.flags = (KEY_PRESSED if pressed else 0) | \
+                     (KEY_FILTERED if filtered else 0) | \
+                     (KEY_REPEATED if repeated else 0)
         self.string = string
         self.keysym = keysym
         self.status = status
         self.symbol = symbol
         self.mods_mask = mods_mask
         self.modifiers = modifiers
+        self.time = time
+        self.received = received
+        self.processed = processed
+        self.dispatched = dispatched
+        self.device = device
+        self.skipped = skipped
+        self.count = count
+
+    pressed = _flag_property(KEY_PRESSED)
+    filtered = _flag_property(KEY_FILTERED)
+    repeated = _flag_property(KEY_REPEATED)
+
+
+# replay pacing (in events)
+REPLAY_CHUNK = 64
+
+# minimum interval between autorepeat updates (in seconds)
+REPEAT_INTERVAL = 0.5
+
+# keys waiting to be delivered before the overload policy applies
+QUEUE_SIZE = 1024
+
+
+# Fixed-size KeyData records, as published by the listener process. Strings
+# longer than the slot continue in the following records (KEY_MORE), which
+# only carry the rest of the string; the flags tell which optional fields
+# are set.
+KEY_RECORD = struct.Struct(str('=ddIIIiiIIB32s32s'))
+KEY_RECORD_SLOTS = 4096
+KEY_STRING_SLOT = 32
+
+KEY_STRING   = 0b0001000
+KEY_STATUS   = 0b0010000
+KEY_RECEIVED = 0b0100000
+KEY_MORE     = 0b1000000
+
+# overload counters published by the listener process
+QUEUE_COUNTERS = ('queue_dropped', 'queue_collapsed', 'queue_summarized')
+
+# retry interval while the records do not fit the ring (in seconds)
+RING_RETRY = 0.01
+
+
+def key_pack(data):
+    flags = data.flags
+    if data.string is not None: flags |= KEY_STRING
+    if data.status is not None: flags |= KEY_STATUS
+    if data.received is not None: flags |= KEY_RECEIVED
+    string = (data.string or '').encode('utf-8')
+    chunks = [string[i:i + KEY_STRING_SLOT]
+              for i in range(KEY_STRING_SLOT, len(string), KEY_STRING_SLOT)]
+    records = [(data.received or 0., data.processed, data.time, data.keysym, data.mods_mask,
+                data.status or 0, -1 if data.device is None else data.device, data.skipped,
+                data.count, flags | (KEY_MORE if chunks else 0),
+                string[:KEY_STRING_SLOT], data.symbol or b'')]
+    for i, chunk in enumerate(chunks):
+        more = KEY_MORE if i < len(chunks) - 1 else 0
+        records.append((0., 0., 0, 0, 0, 0, 0, 0, 0, more, chunk, b''))
+    return records
+
+
+def key_unpack(records):
+    ret = []
+    string = None
+    for record in records:
+        received, processed, time, keysym, mods_mask, status, device, skipped, count, \
+            flags, chunk, symbol = record
+        if string is not None:
+            # continuation of the previous string (split on bytes)
+            string.append(chunk.rstrip(b'\0'))
+            if not flags & KEY_MORE:
+                ret[-1].string = b''.join(string).decode('utf-8')
+                string = None
+            continue
+        data = KeyData()
+        data.flags = flags & (KEY_PRESSED | KEY_FILTERED | KEY_REPEATED)
+        if flags & KEY_MORE:
+            string = [chunk]
+        elif flags & KEY_STRING:
+            data.string = chunk.rstrip(b'\0').decode('utf-8')
+        if flags & KEY_STATUS:
+            data.status = status
+        if flags & KEY_RECEIVED:
+            data.received = received
+        data.processed = processed
+        data.time = time
+        data.keysym = keysym
+        data.symbol = symbol.rstrip(b'\0') or None
+        data.mods_mask = mods_mask
+        data.modifiers = MODIFIERS[mods_mask & MODIFIERS_MASK]
+        data.device = None if device < 0 else device
+        data.skipped = skipped
+        data.count = count
+        ret.append(data)
+    return ret
+
+
+def same_key(a, b):
+    return a.keysym == b.keysym and a.mods_mask == b.mods_mask and a.string == b.string
 
 
 class InputType:
@@ -166,20 +409,91 @@ class InputType:
 
 
 class InputListener(threading.Thread):
-    def __init__(self, callback, input_types=InputType.all, kbd_compose=True, kbd_translate=True):
+    def __init__(self, callback, input_types=InputType.all, kbd_compose=True, kbd_translate=True,
+                 compose_engine='xim', translator='xlib', relay='server', capture='record',
+                 devices=None, loop='thread', queue_size=QUEUE_SIZE, overload='collapse',
+                 record=None, replay=None, replay_fast=False):
         super(InputListener, self).__init__()
         self.callback = callback
         self.input_types = input_types
         self.kbd_compose = kbd_compose
         self.kbd_translate = kbd_translate
+        self.compose_engine = compose_engine
+        if translator == 'xkbcommon' and not xkbcommon.available:
+            warnings.warn("libxkbcommon is not available, using Xlib for translation")
+            translator = 'xlib'
+        if kbd_compose and compose_engine == 'xim':
+            # the input method translates while composing
+            translator = 'xlib'
+        self.translator = translator
+        self.use_xim = (compose_engine == 'xim' and translator == 'xlib')
+        # without an input method there's nothing to relay through the server
+        self.relay = relay if self.use_xim else 'local'
+        if capture == 'xi2' and not xlib.xi2_available:
+            warnings.warn("libXi is not available, using the record extension for capture")
+            capture = 'record'
+        self.capture = capture
+        self.devices = devices
+        self.loop = loop
+        self.queue_size = queue_size
+        self.overload = overload
+        self.record = record
+        self.replay = replay
+        self.replay_fast = replay_fast
+        # stop() only sets the flag and writes to the wakeup pipe: the lock
+        # just keeps it from racing with the pipe being closed
         self.lock = threading.Lock()
         self._stop = True
+        self._wakeup = None
         self.error = None
+        self.queue = []
+        self.queue_lock = threading.Lock()
+        self.queue_pending = False
+        self._relay_queue = deque()
+        self._repeat = None
+        self._repeat_sent = 0.
+        self._xi2_dpy = None
+        self._pid = None
+        self.server_clock = ServerClock()
+        # counters are redirected to the parent in process mode
+        self.incr = stats.incr
+
+
+    def _event_relay(self, ev):
+        if self.relay == 'local':
+            # queue a copy locally, skipping the round-trip through the server
+            copy = xlib.XEvent()
+            xlib.pointer(copy)[0] = ev
+            copy.xany.display = self.replay_dpy
+            copy.xany.window = self.replay_win
+            self._relay_queue.append(copy)
+        else:
+            xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, ev)
 
 
-    def _event_received(self, ev):
+    def _relay_peek(self):
+        if self.relay == 'local':
+            return self._relay_queue[0] if len(self._relay_queue) else None
+        if not xlib.XPending(self.replay_dpy):
+            return None
+        ev = xlib.XEvent()
+        xlib.XPeekEvent(self.replay_dpy, xlib.byref(ev))
+        return ev
+
+
+    def _relay_process(self):
+        while len(self._relay_queue):
+            ev = self._relay_queue.popleft()
+            if self.input_types & InputType.keyboard:
+                self._kbd_process(ev)
+
+
+    def _event_received(self, ev, device=None):
         if xlib.KeyPress <= ev.type <= xlib.MotionNotify:
-            xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, ev)
+            if ev.type in [xlib.KeyPress, xlib.KeyRelease]:
+                self._kbd_received.append((ev.type, ev.xkey.time, ev.xkey.keycode,
+                                           monotonic(), device))
+            self._event_relay(ev)
         elif ev.type in [xlib.FocusIn, xlib.FocusOut]:
             # Forward the event as a custom message in the same queue instead
             # of resetting the XIC directly, in order to preserve queued events
@@ -188,30 +502,117 @@ class InputListener(threading.Thread):
             fwd_ev.xclient.message_type = self.custom_atom
             fwd_ev.xclient.format = 32
             fwd_ev.xclient.data[0] = ev.type
-            xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, fwd_ev)
+            self._event_relay(fwd_ev)
 
 
     def _event_callback(self, data):
         self.callback(data)
         return False
 
+
+    def _event_drain(self):
+        with self.queue_lock:
+            batch = self.queue
+            self.queue = []
+            self.queue_pending = False
+        self.callback(batch)
+        return False
+
+
+    def _queue_put(self, data):
+        queue = self.queue
+        if not self.queue_size or len(queue) < self.queue_size:
+            queue.append(data)
+        elif self.overload == 'summarize':
+            # replace the backlog with the count of the discarded keys
+            data.skipped = sum(ev.skipped + (ev.count if ev.pressed else 0) for ev in queue)
+            self.incr('queue_summarized', len(queue))
+            self.queue = [data]
+        else:
+            i = 0
+            if self.overload == 'collapse':
+                # autorepeat only grows the repeat count: discard it first
+                for i, ev in enumerate(queue):
+                    if ev.pressed and ev.repeated:
+                        break
+                else:
+                    i = 0
+            ev = queue.pop(i)
+            queue.append(data)
+            if ev.pressed and ev.repeated and self.overload == 'collapse':
+                # the repeat count is kept by the same key next to it
+                prev = queue[i - 1] if i else None
+                if prev is not None and prev.pressed and same_key(prev, ev):
+                    prev.count += ev.count
+                    prev.time = ev.time
+                    prev.received = ev.received
+                    prev.processed = ev.processed
+                    self.incr('queue_collapsed')
+                    return
+                succ = queue[i]
+                if succ.pressed and succ.repeated and same_key(succ, ev):
+                    succ.count += ev.count
+                    self.incr('queue_collapsed')
+                    return
+            self.incr('queue_dropped')
+
+
     def _event_processed(self, data):
-        data.symbol = xlib.XKeysymToString(data.keysym)
+        data.symbol = self._kbd_keymap.name(data.keysym)
         if data.string is None:
             data.string = keysym_to_unicode(data.keysym)
-        glib.idle_add(self._event_callback, data)
+        data.processed = monotonic()
+        if data.received is not None:
+            server = self.server_clock.to_local(data.time, data.received)
+            stats.record('server', data.received - server)
+            stats.record('listener', data.processed - data.received)
+        self._event_coalesce(data)
+
+
+    def _event_coalesce(self, data):
+        # autorepeat of the same key is merged into a single pending event,
+        # which is delivered at most every REPEAT_INTERVAL and always before
+        # any other event (such as the final release)
+        pending = self._repeat
+        if data.pressed and data.repeated and not data.filtered:
+            if pending is not None and pending.keysym == data.keysym and \
+               pending.mods_mask == data.mods_mask and pending.string == data.string:
+                # stamped as the last merged repeat
+                pending.count += 1
+                pending.time = data.time
+                pending.received = data.received
+                pending.processed = data.processed
+            else:
+                if pending is not None:
+                    self._event_queue(pending)
+                pending = self._repeat = data
+            if data.processed - self._repeat_sent >= REPEAT_INTERVAL:
+                self._repeat = None
+                self._repeat_sent = data.processed
+                self._event_queue(pending)
+            return
+        if pending is not None:
+            self._repeat = None
+            self._event_queue(pending)
+        self._event_queue(data)
+
+
+    def _event_queue(self, data):
+        if self.loop != 'thread':
+            # delivered once the pending descriptors are processed
+            self._queue_put(data)
+            return
+        with self.queue_lock:
+            self._queue_put(data)
+            if self.queue_pending:
+                return
+            self.queue_pending = True
+        # a single drain is scheduled for all the events queued until then
+        glib.idle_add(self._event_drain)
 
 
     def _event_modifiers(self, kev, data):
-        data.modifiers = modifiers = {}
-        modifiers['shift'] = bool(kev.state & xlib.ShiftMask)
-        modifiers['caps_lock'] = bool(kev.state & xlib.LockMask)
-        modifiers['ctrl'] = bool(kev.state & xlib.ControlMask)
-        modifiers['alt'] = bool(kev.state & xlib.Mod1Mask)
-        modifiers['num_lock'] = bool(kev.state & xlib.Mod2Mask)
-        modifiers['hyper'] = bool(kev.state & xlib.Mod3Mask)
-        modifiers['super'] = bool(kev.state & xlib.Mod4Mask)
-        modifiers['alt_gr'] = bool(kev.state & xlib.Mod5Mask)
+        data.modifiers = MODIFIERS[kev.state & MODIFIERS_MASK]
 
 
     def _event_keypress(self, kev, data):
@@ -220,6 +621,11 @@ class InputListener(threading.Thread):
         status = xlib.Status()
         ret = xlib.Xutf8LookupString(self._kbd_replay_xic, kev, buf, len(buf),
                                      xlib.byref(keysym), xlib.byref(status))
+        if status.value == xlib.XBufferOverflow:
+            # committed text can be longer: ret is the required size
+            buf = xlib.create_string_buffer(ret)
+            ret = xlib.Xutf8LookupString(self._kbd_replay_xic, kev, buf, len(buf),
+                                         xlib.byref(keysym), xlib.byref(status))
         if ret != xlib.NoSymbol:
             if 32 <= keysym.value <= 126:
                 # avoid ctrl sequences, just take the character value
@@ -233,27 +639,134 @@ class InputListener(threading.Thread):
         data.status = status.value
 
 
+    def _event_translate(self, kev, data):
+        # translation without an input method
+        if self._kbd_xkb is not None:
+            data.keysym, data.string = self._kbd_xkb.lookup(kev.keycode, kev.state)
+        else:
+            keysym = xlib.KeySym()
+            xlib.XLookupString(kev, None, 0, xlib.byref(keysym), None)
+            data.keysym = keysym.value
+            data.string = keysym_to_unicode(data.keysym)
+        if 32 <= data.keysym <= 126:
+            # avoid ctrl sequences, just take the character value
+            data.string = chr(data.keysym)
+        data.status = xlib.XLookupBoth if data.string is not None else xlib.XLookupKeySym
+
+        if self._kbd_composer is not None:
+            ret = self._kbd_composer.feed(data.keysym)
+            if ret is True:
+                data.filtered = True
+            elif ret is not None:
+                string, keysym = ret
+                data.string = string or None
+                if keysym:
+                    data.keysym = keysym
+
+
     def _event_lookup(self, kev, data):
         # this is mostly for debugging: we do not account for group/level
-        data.keysym = xlib.XkbKeycodeToKeysym(kev.display, kev.keycode, 0, 0)
+        data.keysym = self._kbd_keymap.keysym(kev.keycode)
 
 
     def start(self):
-        self.lock.acquire()
         self._stop = False
         self.error = None
+        if self.loop == 'glib':
+            self._watch_start()
+            return
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            set_nonblocking(fd)
+        if self.loop == 'process':
+            self._proc_start()
+            return
         super(InputListener, self).start()
 
 
     def stop(self):
+        if self.loop == 'glib':
+            if not self._stop:
+                self._stop = True
+                self._watch_stop()
+            return
         with self.lock:
             if not self._stop:
                 self._stop = True
-                xlib.XRecordDisableContext(self.control_dpy, self.record_ctx)
+                try:
+                    os.write(self._wakeup[1], b'\0')
+                except OSError as e:
+                    # a full pipe already has a pending wakeup
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+
+    def _wakeup_drain(self):
+        # the pipe is written by stop() only, which cannot set the flag of
+        # the child in process mode: both a wakeup and EOF request a stop
+        self._stop = True
+        try:
+            while os.read(self._wakeup[0], 64):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+    def _wakeup_close(self):
+        with self.lock:
+            self._stop = True
+            if self._wakeup is not None:
+                for fd in self._wakeup:
+                    if fd is not None:
+                        os.close(fd)
+                self._wakeup = None
+
+
+    def join(self, timeout=None):
+        if self.loop == 'process':
+            self._proc_join()
+        elif self.loop == 'thread':
+            super(InputListener, self).join(timeout)
+
+
+    def is_alive(self):
+        if self.loop == 'process':
+            return self._pid is not None
+        elif self.loop == 'glib':
+            return not self._stop
+        return super(InputListener, self).is_alive()
 
 
     def _kbd_init(self):
         self._kbd_last_ev = xlib.XEvent()
+        self._kbd_received = deque()
+        self._kbd_keymap = KeyboardMap(self.replay_dpy)
+
+        # keyboard changes are not always reported with a core MappingNotify
+        opcode, error_base = xlib.c_int(), xlib.c_int()
+        event_base = xlib.c_int()
+        major = xlib.c_int(xlib.XkbMajorVersion)
+        minor = xlib.c_int(xlib.XkbMinorVersion)
+        if xlib.XkbQueryExtension(self.replay_dpy, xlib.byref(opcode), xlib.byref(event_base),
+                                  xlib.byref(error_base), xlib.byref(major), xlib.byref(minor)):
+            self._kbd_xkb_event = event_base.value
+            xlib.XkbSelectEvents(self.replay_dpy, xlib.XkbUseCoreKbd,
+                                 xlib.XkbNewKeyboardNotifyMask, xlib.XkbNewKeyboardNotifyMask)
+        else:
+            self._kbd_xkb_event = None
+
+        self._kbd_composer = None
+        self._kbd_xkb = None
+        if not self.use_xim:
+            # compose sequences and translation are resolved in-process
+            self._kbd_replay_xim = None
+            self._kbd_replay_xic = None
+            if self.kbd_compose and self.compose_engine == 'table':
+                self._kbd_composer = Composer(load_table())
+            if self.translator == 'xkbcommon':
+                self._kbd_xkb = xkbcommon.Translator(self.replay_dpy)
+            return
 
         if self.kbd_compose:
             style = xlib.XIMPreeditNothing | xlib.XIMStatusNothing
@@ -274,8 +787,32 @@ class InputListener(threading.Thread):
 
 
     def _kbd_del(self):
-        xlib.XDestroyIC(self._kbd_replay_xic)
-        xlib.XCloseIM(self._kbd_replay_xim)
+        if self._kbd_xkb is not None:
+            self._kbd_xkb.close()
+        if self._kbd_replay_xic is not None:
+            xlib.XDestroyIC(self._kbd_replay_xic)
+            xlib.XCloseIM(self._kbd_replay_xim)
+
+
+    def _kbd_keymap_changed(self):
+        self._kbd_keymap.refresh()
+        if self._kbd_xkb is not None:
+            self._kbd_xkb.reload()
+
+
+    def _kbd_receipt(self, kev):
+        # match an event relayed through the replay window to its reception
+        queue = self._kbd_received
+        while len(queue):
+            ev_type, ev_time, ev_keycode, received, device = queue[0]
+            if ev_type == kev.type and ev_time == kev.time and ev_keycode == kev.keycode:
+                queue.popleft()
+                return received, device
+            if ev_time >= kev.time:
+                # not relayed by us (eg: generated by the input method)
+                break
+            queue.popleft()
+        return None, None
 
 
     def _kbd_process(self, ev):
@@ -283,18 +820,31 @@ class InputListener(threading.Thread):
            ev.xclient.message_type == self.custom_atom:
             if ev.xclient.data[0] in [xlib.FocusIn, xlib.FocusOut]:
                 # we do not keep track of multiple XICs, just reset
-                xic = xlib.Xutf8ResetIC(self._kbd_replay_xic)
-                if xic is not None: xlib.XFree(xic)
+                if self._kbd_composer is not None:
+                    self._kbd_composer.reset()
+                if self._kbd_replay_xic is not None:
+                    xic = xlib.Xutf8ResetIC(self._kbd_replay_xic)
+                    if xic is not None: xlib.XFree(xic)
             return
+        elif ev.type == xlib.MappingNotify:
+            xlib.XRefreshKeyboardMapping(xlib.byref(ev.xmapping))
+            if ev.xmapping.request == xlib.MappingKeyboard:
+                self._kbd_keymap_changed()
+        elif ev.type == self._kbd_xkb_event:
+            if ev.xkb.xkb_type == xlib.XkbNewKeyboardNotify:
+                self._kbd_keymap_changed()
         elif ev.type in [xlib.KeyPress, xlib.KeyRelease]:
             # fake keyboard event data for XFilterEvent
             ev.xkey.send_event = False
             ev.xkey.window = self.replay_win
+            received, device = self._kbd_receipt(ev.xkey)
 
         # pass _all_ events to XFilterEvent
-        filtered = bool(xlib.XFilterEvent(ev, 0))
+        filtered = False
+        if self._kbd_replay_xic is not None:
+            filtered = bool(xlib.XFilterEvent(ev, 0))
         if ev.type == xlib.KeyRelease and \
-           phantom_release(self.replay_dpy, ev.xkey):
+           phantom_release(self._relay_peek(), ev.xkey):
             return
         if ev.type not in [xlib.KeyPress, xlib.KeyRelease]:
             return
@@ -307,16 +857,154 @@ class InputListener(threading.Thread):
                          ev.xkey.state == self._kbd_last_ev.xkey.state and \
                          ev.xkey.keycode == self._kbd_last_ev.xkey.keycode)
         data.mods_mask = ev.xkey.state
+        data.time = ev.xkey.time
+        data.received = received
+        data.device = device
         self._event_modifiers(ev.xkey, data)
         if not data.filtered and data.pressed and self.kbd_translate:
-            self._event_keypress(ev.xkey, data)
+            if self._kbd_replay_xic is not None:
+                self._event_keypress(ev.xkey, data)
+            else:
+                self._event_translate(ev.xkey, data)
         else:
             self._event_lookup(ev.xkey, data)
         self._event_processed(data)
         self._kbd_last_ev = ev
 
 
-    def run(self):
+    def _xi2_init(self, capture):
+        dpy = self._xi2_dpy = xlib.XOpenDisplay(None)
+        opcode, event_base, error_base = xlib.c_int(), xlib.c_int(), xlib.c_int()
+        if not xlib.XQueryExtension(dpy, b"XInputExtension", xlib.byref(opcode),
+                                    xlib.byref(event_base), xlib.byref(error_base)):
+            raise Exception("XInput extension not available")
+        # raw events are delivered during grabs only since XI 2.1
+        major, minor = xlib.c_int(2), xlib.c_int(2)
+        if xlib.XIQueryVersion(dpy, xlib.byref(major), xlib.byref(minor)) != 0 or \
+           (major.value, minor.value) < (2, 1):
+            raise Exception("XInput 2.1 not available")
+        self._xi2_opcode = opcode.value
+        self._xi2_root = xlib.XDefaultRootWindow(dpy)
+        self._xi2_capture = capture if self.record is not None else None
+        self._xi2_ev = xlib.XEvent()
+
+        evtypes = []
+        if self.input_types & InputType.keyboard:
+            evtypes.extend([xlib.XI_RawKeyPress, xlib.XI_RawKeyRelease])
+        if self.input_types & InputType.button:
+            evtypes.extend([xlib.XI_RawButtonPress, xlib.XI_RawButtonRelease])
+        if self.input_types & InputType.movement:
+            evtypes.append(xlib.XI_RawMotion)
+        xi2_select(dpy, self._xi2_root, evtypes, self.devices or [xlib.XIAllMasterDevices])
+
+        # raw events do not carry the modifier state: track it with XKB
+        major = xlib.c_int(xlib.XkbMajorVersion)
+        minor = xlib.c_int(xlib.XkbMinorVersion)
+        if not xlib.XkbQueryExtension(dpy, xlib.byref(opcode), xlib.byref(event_base),
+                                      xlib.byref(error_base), xlib.byref(major), xlib.byref(minor)):
+            raise Exception("XKB extension not available")
+        self._xi2_xkb_event = event_base.value
+        xlib.XkbSelectEvents(dpy, xlib.XkbUseCoreKbd,
+                             xlib.XkbStateNotifyMask, xlib.XkbStateNotifyMask)
+        state = xlib.XkbStateRec()
+        xlib.XkbGetState(dpy, xlib.XkbUseCoreKbd, xlib.byref(state))
+        self._xi2_state = state.lookup_mods | (state.group << 13)
+
+        # focus changes are not visible either: follow the active window
+        self._xi2_active_atom = xlib.XInternAtom(dpy, b"_NET_ACTIVE_WINDOW", False)
+        if self.input_types & InputType.keyboard:
+            xlib.XSelectInput(dpy, self._xi2_root, xlib.PropertyChangeMask)
+        xlib.XFlush(dpy)
+
+
+    def _xi2_del(self):
+        xlib.XCloseDisplay(self._xi2_dpy)
+        self._xi2_dpy = None
+
+
+    def _xi2_received(self, ev, device):
+        if self._xi2_capture is not None:
+            self._xi2_capture.write(monotonic(), xlib.XEventToWire(ev))
+        self._event_received(ev, device)
+
+
+    def _xi2_raw(self, evtype, raw):
+        # rebuild a core event (the relayed event is copied immediately)
+        ev = self._xi2_ev
+        if evtype in [xlib.XI_RawKeyPress, xlib.XI_RawKeyRelease]:
+            ev.type = xlib.KeyPress if evtype == xlib.XI_RawKeyPress else xlib.KeyRelease
+            ev.xkey.keycode = raw.detail
+        elif evtype in [xlib.XI_RawButtonPress, xlib.XI_RawButtonRelease]:
+            ev.type = xlib.ButtonPress if evtype == xlib.XI_RawButtonPress else xlib.ButtonRelease
+            ev.xbutton.button = raw.detail
+        elif evtype == xlib.XI_RawMotion:
+            ev.type = xlib.MotionNotify
+            ev.xmotion.is_hint = 0
+        else:
+            return
+
+        # key, button and motion events share the common fields
+        ev.xkey.serial = raw.serial
+        ev.xkey.display = raw.display
+        ev.xkey.window = self._xi2_root
+        ev.xkey.root = self._xi2_root
+        ev.xkey.time = raw.time
+        ev.xkey.state = self._xi2_state
+        ev.xkey.same_screen = True
+        self._xi2_received(ev, raw.sourceid)
+
+
+    def _xi2_process(self):
+        dpy = self._xi2_dpy
+        ev = xlib.XEvent()
+        while xlib.XPending(dpy):
+            xlib.XNextEvent(dpy, xlib.byref(ev))
+            if ev.type == xlib.GenericEvent:
+                cookie = ev.xcookie
+                if cookie.extension != self._xi2_opcode or \
+                   not xlib.XGetEventData(dpy, xlib.byref(cookie)):
+                    continue
+                try:
+                    raw = xlib.cast(cookie.data, xlib.POINTER(xlib.XIRawEvent)).contents
+                    self._xi2_raw(cookie.evtype, raw)
+                finally:
+                    xlib.XFreeEventData(dpy, xlib.byref(cookie))
+            elif ev.type == self._xi2_xkb_event:
+                if ev.xkb.xkb_type == xlib.XkbStateNotify:
+                    state = ev.xkbstate
+                    self._xi2_state = state.lookup_mods | (state.group << 13)
+            elif ev.type == xlib.PropertyNotify:
+                if ev.xproperty.atom == self._xi2_active_atom:
+                    self._xi2_received(xlib.XEvent(xlib.FocusIn), None)
+
+
+    def _replay_feed(self, capture):
+        # relay the captured events which are due, returning the time until
+        # the next one (None when the capture is exhausted)
+        now = monotonic()
+        fed = 0
+        delay = None
+        while self._replay_pos < len(capture):
+            stamp, data = capture[self._replay_pos]
+            if self.replay_fast:
+                if fed == REPLAY_CHUNK:
+                    delay = 0
+                    break
+            else:
+                delay = (stamp - self._replay_base) - (now - self._replay_start)
+                if delay > 0:
+                    break
+            self._event_received(self._replay_decoder.decode(data))
+            self._replay_pos += 1
+            fed += 1
+        else:
+            delay = None
+        if fed:
+            xlib.XFlush(self.replay_dpy)
+        return delay
+
+
+    def _open(self):
         # control connection
         self.control_dpy = xlib.XOpenDisplay(None)
         xlib.XSynchronize(self.control_dpy, True)
@@ -324,96 +1012,341 @@ class InputListener(threading.Thread):
         # unmapped replay window
         self.replay_dpy = xlib.XOpenDisplay(None)
         self.custom_atom = xlib.XInternAtom(self.replay_dpy, b"SCREENKEY", False)
-        replay_fd = xlib.XConnectionNumber(self.replay_dpy)
-        self.replay_win = create_replay_window(self.replay_dpy)
+        self._replay_fd = xlib.XConnectionNumber(self.replay_dpy)
+        if not self.use_xim:
+            self.replay_win = 0
+        else:
+            self.replay_win = create_replay_window(self.replay_dpy)
 
         # bail during initialization errors
+        capture = self._capture = None
         try:
+            if self.replay is not None:
+                capture = self._capture = CaptureReader(self.replay)
+            elif self.record is not None:
+                capture = self._capture = CaptureWriter(self.record)
             if self.input_types & InputType.keyboard:
                 self._kbd_init()
+            if self.replay is None and self.capture == 'xi2':
+                self._xi2_init(capture)
         except Exception as e:
             self.error = e
+            if self._xi2_dpy is not None:
+                self._xi2_del()
+            if capture is not None:
+                capture.close()
             xlib.XCloseDisplay(self.control_dpy)
-            xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
+            if self.replay_win:
+                xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
             xlib.XCloseDisplay(self.replay_dpy)
 
             # cheap wakeup() equivalent for compatibility
             glib.idle_add(self._event_callback, None)
 
-            self._stop = True
-            self.lock.release()
-            return
+            self._wakeup_close()
+            return False
+
+        self._record_dpy = None
+        if self.replay is not None:
+            # captured events replace the recording context entirely
+            self._fds = [self._replay_fd]
+            self._replay_pos = 0
+            self._replay_decoder = xlib.WireDecoder(self.replay_dpy)
+            self._replay_start = monotonic()
+            self._replay_base = capture[0][0] if len(capture) else 0.
+        elif self.capture == 'xi2':
+            # raw events are selected directly on the root window
+            self._xi2_fd = xlib.XConnectionNumber(self._xi2_dpy)
+            self._fds = [self._xi2_fd, self._replay_fd]
+        else:
+            # initialize recording context
+            ev_ranges = []
+            dev_ranges = []
+            if self.input_types & InputType.keyboard:
+                ev_ranges.append([xlib.FocusIn, xlib.FocusOut])
+                dev_ranges.append([xlib.KeyPress, xlib.KeyRelease])
+            if self.input_types & InputType.button:
+                dev_ranges.append([xlib.ButtonPress, xlib.ButtonRelease])
+            if self.input_types & InputType.movement:
+                dev_ranges.append([xlib.MotionNotify, xlib.MotionNotify])
+            self.record_ctx = record_context(self.control_dpy, ev_ranges, dev_ranges);
+
+            self._record_dpy = xlib.XOpenDisplay(None)
+            self._record_fd = xlib.XConnectionNumber(self._record_dpy)
+            # we need to keep the record_ref alive(!)
+            self._record_ref = record_enable(self._record_dpy, self.record_ctx,
+                                             self._event_received, capture)
+            self._fds = [self._record_fd, self._replay_fd]
+        return True
+
+
+    def _pending(self):
+        # descriptors with events already buffered by Xlib
+        r_fd = []
+        if self._record_dpy is not None and xlib.XPending(self._record_dpy):
+            r_fd.append(self._record_fd)
+        if self._xi2_dpy is not None and xlib.XPending(self._xi2_dpy):
+            r_fd.append(self._xi2_fd)
+        if xlib.XPending(self.replay_dpy):
+            r_fd.append(self._replay_fd)
+        return r_fd
+
+
+    def _dispatch(self, r_fd):
+        if self._record_dpy is not None and self._record_fd in r_fd:
+            xlib.XRecordProcessReplies(self._record_dpy)
+            xlib.XFlush(self.replay_dpy)
+            self._relay_process()
+
+        if self._xi2_dpy is not None and self._xi2_fd in r_fd:
+            self._xi2_process()
+            xlib.XFlush(self.replay_dpy)
+            self._relay_process()
+
+        if self._replay_fd in r_fd:
+            while xlib.XPending(self.replay_dpy):
+                # a fresh event each time: the last one is kept for comparison
+                ev = xlib.XEvent()
+                xlib.XNextEvent(self.replay_dpy, xlib.byref(ev))
+                if self.input_types & InputType.keyboard:
+                    self._kbd_process(ev)
+
+
+    def _close(self):
+        if self._record_dpy is not None:
+            xlib.XRecordDisableContext(self.control_dpy, self.record_ctx)
+            xlib.XRecordFreeContext(self.control_dpy, self.record_ctx)
+            xlib.XCloseDisplay(self._record_dpy)
+            self._record_dpy = None
+            self._record_ref = None
+        if self._xi2_dpy is not None:
+            self._xi2_del()
+        xlib.XCloseDisplay(self.control_dpy)
+        if self._capture is not None:
+            self._capture.close()
 
-        # initialize recording context
-        ev_ranges = []
-        dev_ranges = []
         if self.input_types & InputType.keyboard:
-            ev_ranges.append([xlib.FocusIn, xlib.FocusOut])
-            dev_ranges.append([xlib.KeyPress, xlib.KeyRelease])
-        if self.input_types & InputType.button:
-            dev_ranges.append([xlib.ButtonPress, xlib.ButtonRelease])
-        if self.input_types & InputType.movement:
-            dev_ranges.append([xlib.MotionNotify, xlib.MotionNotify])
-        self.record_ctx = record_context(self.control_dpy, ev_ranges, dev_ranges);
+            self._kbd_del()
+
+        if self.replay_win:
+            xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
+        xlib.XCloseDisplay(self.replay_dpy)
 
-        record_dpy = xlib.XOpenDisplay(None)
-        record_fd = xlib.XConnectionNumber(record_dpy)
-        # we need to keep the record_ref alive(!)
-        record_ref = record_enable(record_dpy, self.record_ctx, self._event_received)
+        self._wakeup_close()
 
-        # event loop
-        self.lock.release()
-        while True:
-            with self.lock:
-                if self._stop:
-                    break
 
-            r_fd = []
-            if xlib.XPending(record_dpy):
-                r_fd.append(record_fd)
-            if xlib.XPending(self.replay_dpy):
-                r_fd.append(replay_fd)
+    def run(self):
+        if not self._open():
+            return
+
+        # event loop
+        poller = select.poll()
+        for fd in self._fds + [self._wakeup[0]]:
+            poller.register(fd, select.POLLIN)
+        while not self._stop:
+            timeout = None
+            if self.replay is not None:
+                timeout = self._replay_feed(self._capture)
+                self._relay_process()
+
+            r_fd = self._pending()
             if not r_fd:
-                r_fd, _, _ = select.select([record_fd, replay_fd], [], [])
+                if self.loop == 'process':
+                    self._flush()
+                    if self.queue:
+                        # the ring is full: retry once the GUI catches up
+                        timeout = RING_RETRY if timeout is None else min(timeout, RING_RETRY)
+                ms = None if timeout is None else int(math.ceil(timeout * 1000))
+                r_fd = [fd for fd, _ in poller.poll(ms)]
             if not r_fd:
-                break
+                continue
+            if self._wakeup[0] in r_fd:
+                self._wakeup_drain()
+                continue
+            self._dispatch(r_fd)
+            if self.loop == 'process':
+                self._flush()
 
-            if record_fd in r_fd:
-                xlib.XRecordProcessReplies(record_dpy)
-                xlib.XFlush(self.replay_dpy)
+        self._close()
 
-            if replay_fd in r_fd:
-                ev = xlib.XEvent()
-                xlib.XNextEvent(self.replay_dpy, xlib.byref(ev))
-                if self.input_types & InputType.keyboard:
-                    self._kbd_process(ev)
 
-        # finalize
-        self.lock.acquire()
+    # main loop mode: the descriptors are watched by the GLib main loop and
+    # processed on the main thread, with the results delivered directly
+    def _watch_start(self):
+        if not self._open():
+            return
+        self._watches = [glib.io_add_watch(fd, glib.IO_IN, self._watch_ready)
+                         for fd in self._fds]
+        self._watch_timer = None
+        if self.replay is not None:
+            self._watch_replay()
+
+
+    def _watch_stop(self):
+        for source in self._watches:
+            glib.source_remove(source)
+        if self._watch_timer is not None:
+            glib.source_remove(self._watch_timer)
+        self._close()
+
+
+    def _flush(self):
+        if self.queue:
+            batch = self.queue
+            self.queue = []
+            self.callback(batch)
+
+
+    def _watch_ready(self, fd, cond):
+        r_fd = [fd]
+        while r_fd and not self._stop:
+            self._dispatch(r_fd)
+            r_fd = self._pending()
+        if not self._stop:
+            self._flush()
+        return not self._stop
+
+
+    def _watch_replay(self):
+        self._watch_timer = None
+        timeout = self._replay_feed(self._capture)
+        self._relay_process()
+        self._flush()
+        r_fd = self._pending()
+        if r_fd:
+            self._watch_ready(r_fd[0], glib.IO_IN)
+        if timeout is not None and not self._stop:
+            ms = int(math.ceil(timeout * 1000))
+            self._watch_timer = glib.timeout_add(ms, self._watch_replay)
+        return False
 
-        xlib.XRecordFreeContext(self.control_dpy, self.record_ctx)
-        xlib.XCloseDisplay(self.control_dpy)
-        xlib.XCloseDisplay(record_dpy)
-        del record_ref
 
-        if self.input_types & InputType.keyboard:
-            self._kbd_del()
 
-        xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
-        xlib.XCloseDisplay(self.replay_dpy)
+    # process mode: the listener runs in a child process, which publishes
+    # fixed-size records in a shared ring and notifies each batch through a
+    # pipe. The pipe also reports the termination of the child, and an error
+    # message follows an "E" marker.
+    def _proc_start(self):
+        self._ring = Ring(KEY_RECORD, KEY_RECORD_SLOTS, QUEUE_COUNTERS)
+        self._ring_totals = dict.fromkeys(QUEUE_COUNTERS, 0)
+        notify_r, notify_w = os.pipe()
+        self._pid = os.fork()
+        if self._pid == 0:
+            self._proc_main(notify_r, notify_w)
+        os.close(notify_w)
+        set_nonblocking(notify_r)
+        self._proc_notify = notify_r
+        self._proc_error = None
+        self._proc_watch = glib.io_add_watch(notify_r, glib.IO_IN | glib.IO_HUP,
+                                             self._proc_ready)
+
+
+    def _proc_main(self, notify_r, notify_w):
+        status = 1
+        try:
+            # stop requests come from the parent only
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            os.close(notify_r)
+            os.close(self._wakeup[1])
+            self._wakeup = (self._wakeup[0], None)
+            self._proc_notify = notify_w
+            self.callback = self._proc_publish
+            self.incr = self._ring.incr
+            self.run()
+            if self.error is not None:
+                os.write(notify_w, b'E' + str(self.error).encode('utf-8', 'replace'))
+            status = 0
+        finally:
+            os._exit(status)
+
+
+    def _proc_publish(self, batch):
+        # records which do not fit are held back in the queue, where the
+        # overload policy applies
+        for i, data in enumerate(batch):
+            if not self._ring.put(key_pack(data)):
+                self.queue = batch[i:]
+                break
+        try:
+            os.write(self._proc_notify, b'\0')
+        except OSError as e:
+            if e.errno == errno.EPIPE:
+                self._stop = True
+            elif e.errno != errno.EAGAIN:
+                raise
 
-        self._stop = True
-        self.lock.release()
 
+    def _proc_ready(self, fd, cond):
+        eof = False
+        try:
+            while True:
+                buf = os.read(fd, 4096)
+                if not buf:
+                    eof = True
+                    break
+                if b'E' in buf:
+                    self._proc_error = buf[buf.index(b'E') + 1:]
+                elif self._proc_error is not None:
+                    self._proc_error += buf
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        batch = key_unpack(self._ring.get())
+        for data in batch:
+            if data.received is not None:
+                server = self.server_clock.to_local(data.time, data.received)
+                stats.record('server', data.received - server)
+                stats.record('listener', data.processed - data.received)
+        self._proc_counters()
+        if batch:
+            self.callback(batch)
+        if not eof:
+            return self._pid is not None
+
+        # the child exited on its own unless stopped
+        stopped = self._stop
+        self._proc_watch = None
+        self._proc_join()
+        if not stopped:
+            error = self._proc_error
+            self.error = Exception(error.decode('utf-8', 'replace') if error is not None
+                                   else "listener process terminated")
+            self.callback(None)
+        return False
+
+
+    def _proc_counters(self):
+        for name, total in self._ring.totals().items():
+            if total != self._ring_totals[name]:
+                stats.incr(name, total - self._ring_totals[name])
+                self._ring_totals[name] = total
+
+
+    def _proc_join(self):
+        if self._pid is None:
+            return
+        os.waitpid(self._pid, 0)
+        self._pid = None
+        if self._proc_watch is not None:
+            glib.source_remove(self._proc_watch)
+            self._proc_watch = None
+        os.close(self._proc_notify)
+        self._proc_counters()
+        self._ring.close()
+        self._wakeup_close()
 
 
 if __name__ == '__main__':
-    def callback(data):
-        values = {}
-        for k in dir(data):
-            if k[0] == '_': continue
-            values[k] = getattr(data, k)
-        print(values)
+    def callback(batch):
+        if batch is None:
+            return
+        for data in batch:
+            values = {}
+            for k in dir(data):
+                if k[0] == '_': continue
+                values[k] = getattr(data, k)
+            print(values)
 
     glib.threads_init()
     kl = InputListener(callback)
@@ -5,11 +5,13 @@
 
 from __future__ import print_function, unicode_literals, absolute_import, generators
 
-from .inputlistener import InputListener, InputType
+from .inputlistener import InputListener, InputType, MODIFIERS_MASK, QUEUE_SIZE
+from .stats import stats
+from .timer import Deadline, ServerClock, monotonic
 import glib
 
-from collections import namedtuple
-from datetime import datetime
+from collections import OrderedDict, namedtuple
+import re
 
 # Key replacement data:
 #
@@ -21,7 +23,139 @@ from datetime import datetime
 
 ReplData = namedtuple('ReplData', ['value', 'font', 'suffix'])
 KeyRepl  = namedtuple('KeyRepl',  ['bk_stop', 'silent', 'spaced', 'repl'])
-KeyData  = namedtuple('KeyData',  ['stamp', 'is_ctrl', 'bk_stop', 'silent', 'spaced', 'markup'])
+
+# Stored keys: the flags above are packed as KEY_* bits, and the markup is
+# interned (most keys repeat and share their markup).
+KEY_CTRL    = 0b0001
+KEY_BK_STOP = 0b0010
+KEY_SILENT  = 0b0100
+KEY_SPACED  = 0b1000
+
+# interned markup strings kept before flushing
+MARKUPS_MAX = 4096
+_markups = {}
+
+
+def intern_markup(markup):
+    ret = _markups.get(markup)
+    if ret is None:
+        if len(_markups) >= MARKUPS_MAX:
+            _markups.clear()
+        ret = _markups[markup] = markup
+    return ret
+
+
+class KeyData(object):
+    __slots__ = ('stamp', 'flags', 'markup', 'count')
+
+    def __init__(self, stamp, is_ctrl, bk_stop, silent, spaced, markup):
+        self.stamp = stamp
+        self.count = 1
+        self.flags = (KEY_CTRL if is_ctrl else 0) | \
+                     (KEY_BK_STOP if bk_stop else 0) | \
+                     (KEY_SILENT if silent else 0) | \
+                     (KEY_SPACED if spaced else 0)
+        self.markup = intern_markup(markup)
+
+    is_ctrl = property(lambda self: bool(self.flags & KEY_CTRL))
+    bk_stop = property(lambda self: bool(self.flags & KEY_BK_STOP))
+    silent  = property(lambda self: bool(self.flags & KEY_SILENT))
+    spaced  = property(lambda self: bool(self.flags & KEY_SPACED))
+
+# Rendered markup of a single key:
+#
+# plain:      markup when not underlined
+# head, tail: markup before/after the opening "recent" underline tag
+Fragment = namedtuple('Fragment', ['plain', 'head', 'tail'])
+
+# Parsed markup: UTF-8 text and the spans of its tags (in document order, as
+# byte offsets into the text). attrs contains the (name, value) pairs of
+# <span> tags.
+Piece = namedtuple('Piece', ['text', 'spans'])
+Span  = namedtuple('Span',  ['start', 'end', 'tag', 'attrs'])
+
+_RE_MARKUP = re.compile(r'<(/?)(\w+)([^>]*)>|&(#?\w+);|[^<&]+|.')
+_RE_ATTR = re.compile(r'(\w+)="([^"]*)"')
+_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+
+def parse_markup(markup):
+    parts = []
+    spans = []
+    stack = []
+    ofs = 0
+    for m in _RE_MARKUP.finditer(markup):
+        close, tag, attrs, entity = m.group(1, 2, 3, 4)
+        if tag is not None:
+            if close:
+                i = stack.pop()
+                spans[i] = spans[i]._replace(end=ofs)
+            else:
+                stack.append(len(spans))
+                spans.append(Span(ofs, None, tag, tuple(_RE_ATTR.findall(attrs))))
+            continue
+        if entity is None:
+            chunk = m.group(0)
+        elif entity[0] != '#':
+            chunk = _ENTITIES[entity]
+        elif entity[1] in 'xX':
+            chunk = unichr(int(entity[2:], 16))
+        else:
+            chunk = unichr(int(entity[1:]))
+        chunk = chunk.encode('utf-8')
+        parts.append(chunk)
+        ofs += len(chunk)
+    return Piece(b''.join(parts), spans)
+
+
+def _extend(text, spans, piece):
+    # append a piece to a label under construction
+    ofs = len(text)
+    for span in piece.spans:
+        spans.append(Span(span.start + ofs, span.end + ofs, span.tag, span.attrs))
+    return text + piece.text
+
+
+
+class Label(object):
+    """Structured label text, as produced by LabelManager. The renderer
+    builds the text attributes directly from the spans: markup() is only
+    meant for debugging and testing."""
+
+    def __init__(self, text, spans):
+        self.text = text
+        self.spans = spans
+
+
+    def markup(self):
+        parts = []
+        stack = []
+        ofs = 0
+        for span in self.spans + [None]:
+            start = len(self.text) if span is None else span.start
+            while stack and (span is None or stack[-1].end <= start):
+                top = stack.pop()
+                parts.append(self._escape(ofs, top.end))
+                parts.append('</' + top.tag + '>')
+                ofs = top.end
+            if span is None:
+                break
+            parts.append(self._escape(ofs, start))
+            parts.append('<' + span.tag + ''.join(' {}="{}"'.format(k, v) for k, v in span.attrs) + '>')
+            stack.append(span)
+            ofs = start
+        parts.append(self._escape(ofs, len(self.text)))
+        return ''.join(parts)
+
+
+    def _escape(self, start, end):
+        if start == end:
+            return ''
+        return unicode(glib.markup_escape_text(self.text[start:end].decode('utf-8')))
+
+
+    def __repr__(self):
+        return repr(self.markup())
 
 REPLACE_SYMS = {
     # Regular keys
@@ -133,6 +267,20 @@ REPLACE_MODS = {
 }
 
 
+# modifiers shown in front of keys, in order
+NORMAL_MODS = ('ctrl', 'alt', 'super', 'hyper')
+RAW_MODS = tuple(REPLACE_MODS.keys())
+
+# parsed markup fragments kept before flushing
+PIECES_MAX = 4096
+
+# rendered keys kept in the template cache
+TEMPLATES_MAX = 512
+
+# visible keys kept in the history by default
+HISTORY_SIZE = 1000
+
+
 def keysym_to_mod(keysym):
     for k, v in MODS_SYMS.items():
         if keysym in v:
@@ -142,13 +290,20 @@ def keysym_to_mod(keysym):
 
 class LabelManager(object):
     def __init__(self, listener, logger, key_mode, bak_mode, mods_mode, mods_only,
-                 multiline, vis_shift, vis_space, recent_thr, compr_cnt, ignore, pango_ctx):
+                 multiline, vis_shift, vis_space, recent_thr, compr_cnt, ignore, pango_ctx,
+                 history=HISTORY_SIZE, compose_engine='xim', translator='xlib', relay='server',
+                 capture='record', devices=None, loop='thread', queue_size=QUEUE_SIZE,
+                 overload='collapse', render_fps=0, render_policy='latency', record=None,
+                 replay=None, replay_fast=False):
         self.key_mode = key_mode
         self.bak_mode = bak_mode
         self.mods_mode = mods_mode
         self.logger = logger
         self.listener = listener
-        self.data = []
+        self.render_fps = render_fps
+        self.render_policy = render_policy
+        self.render_timer = Deadline(self.update_text)
+        self.clear()
         self.enabled = True
         self.mods_only = mods_only
         self.multiline = multiline
@@ -157,7 +312,23 @@ class LabelManager(object):
         self.recent_thr = recent_thr
         self.compr_cnt = compr_cnt
         self.ignore = ignore
+        self.history = history
+        self.compose_engine = compose_engine
+        self.translator = translator
+        self.relay = relay
+        self.capture = capture
+        self.devices = devices
+        self.loop = loop
+        self.queue_size = queue_size
+        self.overload = overload
+        self.record = record
+        self.replay = replay
+        self.replay_fast = replay_fast
+        self.width_keys = 0
         self.kl = None
+        self.rendered = None
+        self.server_clock = ServerClock()
+        self.stamp = 0.
         self.font_families = {x.get_name() for x in pango_ctx.list_families()}
         self.update_replacement_map()
 
@@ -170,21 +341,42 @@ class LabelManager(object):
         self.stop()
         compose = (self.key_mode == 'composed')
         translate = (self.key_mode in ['composed', 'translated'])
-        self.kl = InputListener(self.key_press, InputType.keyboard, compose, translate)
+        self.kl = InputListener(self.key_batch, InputType.keyboard, compose, translate,
+                                compose_engine=self.compose_engine,
+                                translator=self.translator, relay=self.relay,
+                                capture=self.capture, devices=self.devices, loop=self.loop,
+                                queue_size=self.queue_size, overload=self.overload,
+                                record=self.record, replay=self.replay,
+                                replay_fast=self.replay_fast)
         self.kl.start()
         self.logger.debug("Thread started.")
 
 
     def stop(self):
+        self.render_timer.cancel()
         if self.kl:
+            start = monotonic()
             self.kl.stop()
-            self.logger.debug("Thread stopped.")
             self.kl.join()
+            self.logger.debug("Thread stopped in {:.1f}ms.".format((monotonic() - start) * 1000))
             self.kl = None
 
 
     def clear(self):
         self.data = []
+        self._reset_fragments()
+        self.render_timer.cancel()
+        self.unrendered = []
+
+
+    def _reset_fragments(self):
+        self.frags = []
+        self.repeats = []
+        self.cache = b''
+        self.cache_ofs = [0]
+        self.cache_spans = []
+        self.cache_nspans = [0]
+        self._dirty = 0
 
 
     def get_repl_markup(self, repl):
@@ -220,64 +412,299 @@ class LabelManager(object):
         for k, v in REPLACE_MODS.items():
             data = v.get(self.mods_mode, v['normal'])
             self.replace_mods[k] = self.get_repl_markup(data)
+        self.mods_prefixes = {}
+        self.pieces = {}
+        self.templates = OrderedDict()
+
+
+    def key_template(self, event, render):
+        # keys are rendered once per symbol/modifier state, as long as the
+        # settings are unchanged
+        key = (event.symbol, event.string, event.mods_mask, self.key_mode, self.mods_mode,
+               self.mods_only, self.vis_shift, self.vis_space, self.multiline)
+        template = self.templates.pop(key, None)
+        if template is None:
+            stats.incr('template_misses')
+            template = render(event)
+            if len(self.templates) >= TEMPLATES_MAX:
+                self.templates.popitem(last=False)
+        else:
+            stats.incr('template_hits')
+        self.templates[key] = template
+        if not template:
+            return False
+        self._push(KeyData(self.stamp, *template))
+        return True
 
 
-    def update_text(self):
-        markup = ""
-        recent = False
-        stamp = datetime.now()
-        repeats = 0
-        for i, key in enumerate(self.data):
-            if i != 0:
-                last = self.data[i - 1]
-
-                # compress repeats
-                if self.compr_cnt and key.markup == last.markup:
-                    repeats += 1
-                    if repeats < self.compr_cnt:
-                        pass
-                    elif i == len(self.data) - 1 or key.markup != self.data[i + 1].markup:
-                        if not recent and (stamp - key.stamp).total_seconds() < self.recent_thr:
-                            markup += '<u>'
-                            recent = True
-                        markup += '<sub><small>…{}×</small></sub>'.format(repeats + 1)
-                        if len(key.markup) and key.markup[-1] == '\n':
-                            markup += '\n'
-                        continue
-                    else:
-                        continue
+    def parse(self, markup):
+        # markup is parsed once: keys and spacing repeat a lot
+        piece = self.pieces.get(markup)
+        if piece is None:
+            if len(self.pieces) >= PIECES_MAX:
+                self.pieces.clear()
+            piece = self.pieces[markup] = parse_markup(markup)
+        return piece
+
+
+    def mods_prefix(self, event, caps):
+        # rendered modifier prefix, cached per modifier state
+        key = (caps, event.mods_mask & MODIFIERS_MASK)
+        mod = self.mods_prefixes.get(key)
+        if mod is None:
+            mod = ''.join(self.replace_mods[cap] for cap in caps if event.modifiers[cap])
+            self.mods_prefixes[key] = mod
+        return mod
+
+
+    def set_width(self, max_keys):
+        # upper bound of the keys which can be visible at once (0 if unknown)
+        self.width_keys = max_keys
+
+
+    def _trim(self):
+        limit = self.history
+        if self.width_keys and not self.multiline:
+            # only the tail is shown on a single line (see ELLIPSIZE_START)
+            limit = min(limit, self.width_keys) if limit else self.width_keys
+        data = self.data
+        if not limit or len(data) <= limit + limit // 4:
+            return
+
+        # never split a run of compressed repeats (at most compr_cnt keys)
+        cut = len(data) - limit
+        if self.compr_cnt:
+            while cut > 0 and data[cut].markup == data[cut - 1].markup:
+                cut -= 1
+        if not cut:
+            return
+
+        # trim in chunks, as the whole label needs to be rendered again
+        del data[:cut]
+        self._reset_fragments()
+
+
+    def _push(self, key):
+        data = self.data
+        if self.compr_cnt and len(data) > self.compr_cnt and \
+           data[-1].markup == key.markup and \
+           (data[-1].count > 1 or
+            all(data[-i].markup == key.markup for i in range(2, self.compr_cnt + 2))):
+            # repeats past compr_cnt are only counted by the last key of the
+            # run, which is shown as the repeat count
+            last = data[-1]
+            last.count += 1
+            last.stamp = key.stamp
+            self._dirty = min(self._dirty, len(data) - 1)
+            return
+        data.append(key)
+        # the previous key is rendered differently depending on its successor
+        self._dirty = min(self._dirty, max(0, len(data) - 2))
+        self._trim()
+
+
+    def _pop(self):
+        last = self.data[-1]
+        if last.count > 1:
+            last.count -= 1
+        else:
+            self.data.pop()
+        self._dirty = min(self._dirty, max(0, len(self.data) - 1))
+
 
-                # character block spacing
-                if len(last.markup) and last.markup[-1] == '\n':
+    def _render_key(self, i, repeats):
+        key = self.data[i]
+        spacing = ''
+        if i != 0:
+            last = self.data[i - 1]
+
+            # compress repeats
+            if self.compr_cnt and key.markup == last.markup:
+                repeats += key.count
+                if repeats < self.compr_cnt:
                     pass
-                elif key.is_ctrl or last.is_ctrl or key.spaced or last.spaced:
-                    markup += ' '
-                elif key.bk_stop or last.bk_stop or repeats > self.compr_cnt:
-                    markup += '<span font_family="sans">\u2009</span>'
-                if key.markup != last.markup:
-                    repeats = 0
-
-            key_markup = key.markup
-            if not recent and (stamp - key.stamp).total_seconds() < self.recent_thr:
-                recent = True
-                key_markup = '<u>' + key_markup
-
-            # disable ligatures
-            if len(key.markup) == 1 and 0x0300 <= ord(key.markup) <= 0x036F:
-                # workaround for pango not handling ZWNJ correctly for combining marks
-                markup += '\u180e' + key_markup + '\u200a'
-            elif len(key_markup):
-                markup += '\u200c' + key_markup
-
-        if len(markup) and markup[-1] == '\n':
-            markup = markup.rstrip('\n')
+                elif i == len(self.data) - 1 or key.markup != self.data[i + 1].markup:
+                    markup = '<sub><small>…{}×</small></sub>'.format(repeats + 1)
+                    if len(key.markup) and key.markup[-1] == '\n':
+                        markup += '\n'
+                    return Fragment(markup, '', markup), repeats
+                else:
+                    return None, repeats
+
+            # character block spacing
+            if len(last.markup) and last.markup[-1] == '\n':
+                pass
+            elif key.is_ctrl or last.is_ctrl or key.spaced or last.spaced:
+                spacing = ' '
+            elif key.bk_stop or last.bk_stop or repeats > self.compr_cnt:
+                spacing = '<span font_family="sans">\u2009</span>'
+            if key.markup != last.markup:
+                repeats = 0
+
+        # disable ligatures
+        if len(key.markup) == 1 and 0x0300 <= ord(key.markup) <= 0x036F:
+            # workaround for pango not handling ZWNJ correctly for combining marks
+            head = spacing + '\u180e'
+            tail = key.markup + '\u200a'
+            return Fragment(head + tail, head, tail), repeats
+        head = spacing + '\u200c'
+        if len(key.markup):
+            return Fragment(head + key.markup, head, key.markup), repeats
+        return Fragment(spacing, head, ''), repeats
+
+
+    def _update_fragments(self):
+        # re-render only the keys which were invalidated since the last update
+        start = min(self._dirty, len(self.frags))
+        del self.frags[start:]
+        del self.repeats[start:]
+        repeats = self.repeats[-1] if len(self.repeats) else 0
+        for i in range(start, len(self.data)):
+            frag, repeats = self._render_key(i, repeats)
+            if frag is not None:
+                frag = Fragment(*(self.parse(markup) for markup in frag))
+            self.frags.append(frag)
+            self.repeats.append(repeats)
+        self._dirty = len(self.data)
+
+        # all fragments but the last are settled and kept as a single text
+        settled = len(self.frags) - 1
+        if len(self.cache_ofs) - 1 > start:
+            del self.cache_ofs[start + 1:]
+            del self.cache_nspans[start + 1:]
+            self.cache = self.cache[:self.cache_ofs[-1]]
+            del self.cache_spans[self.cache_nspans[-1]:]
+        if len(self.cache_ofs) - 1 < settled:
+            ofs = self.cache_ofs[-1]
+            parts = [self.cache]
+            for frag in self.frags[len(self.cache_ofs) - 1:settled]:
+                if frag is not None:
+                    for span in frag.plain.spans:
+                        self.cache_spans.append(Span(span.start + ofs, span.end + ofs,
+                                                     span.tag, span.attrs))
+                    ofs += len(frag.plain.text)
+                    parts.append(frag.plain.text)
+                self.cache_ofs.append(ofs)
+                self.cache_nspans.append(len(self.cache_spans))
+            self.cache = b''.join(parts)
+
+
+    def request_update(self):
+        # label updates are committed at most once per frame (when capped):
+        # "latency" renders immediately unless a frame was just rendered,
+        # "throughput" waits for the next frame boundary
+        if not self.render_fps:
+            self.update_text()
+            return
+        if self.render_timer.pending():
+            stats.incr('render_skipped')
+            return
+        interval = 1. / self.render_fps
+        now = monotonic()
+        if self.render_policy == 'throughput':
+            wait = interval - now % interval
+        elif self.rendered is None:
+            wait = 0.
+        else:
+            wait = self.rendered + interval - now
+        if wait <= 0.:
+            self.update_text()
+        else:
+            self.render_timer.start(wait)
+
+
+    def update_text(self):
+        start = monotonic()
+        self.render_timer.cancel()
+        self._update_fragments()
+        recent = None
+        text = b''
+        spans = []
+        if len(self.frags):
+            # stamps are ordered: scan back only through the recent keys
+            stamp = start - self.recent_thr
+            first = len(self.data)
+            while first > 0 and self.data[first - 1].stamp > stamp:
+                first -= 1
+            while first < len(self.frags) and self.frags[first] is None:
+                first += 1
+
+            settled = len(self.frags) - 1
+            last = self.frags[settled]
+            if first > settled:
+                text = self.cache
+                spans = list(self.cache_spans)
+                if last is not None:
+                    text = _extend(text, spans, last.plain)
+            elif first == settled:
+                spans = list(self.cache_spans)
+                text = _extend(self.cache, spans, last.head)
+                recent = len(text), len(spans)
+                text = _extend(text, spans, last.tail)
+            else:
+                frag = self.frags[first]
+                spans = self.cache_spans[:self.cache_nspans[first]]
+                text = _extend(self.cache[:self.cache_ofs[first]], spans, frag.head)
+                recent = len(text), len(spans)
+                text = _extend(text, spans, frag.tail)
+
+                # the following settled fragments are only shifted
+                ofs = self.cache_ofs[first + 1]
+                shift = len(text) - ofs
+                for span in self.cache_spans[self.cache_nspans[first + 1]:]:
+                    spans.append(Span(span.start + shift, span.end + shift,
+                                      span.tag, span.attrs))
+                text += self.cache[ofs:]
+                if last is not None:
+                    text = _extend(text, spans, last.plain)
+
+        # newlines are never part of a tag
+        if text.endswith(b'\n'):
+            text = text.rstrip(b'\n')
             if not self.vis_space and not self.data[-1].is_ctrl:
                 # always show some return symbol at the last line
-                markup += self.replace_syms['Return'].repl
-        if recent:
-            markup += '</u>'
-        self.logger.debug("Label updated: %s." % repr(markup))
-        self.listener(markup)
+                text = _extend(text, spans, self.parse(self.replace_syms['Return'].repl))
+        if recent is not None:
+            spans.insert(recent[1], Span(recent[0], len(text), 'u', ()))
+        label = Label(text, spans)
+        built = monotonic()
+        stats.record('label', built - start)
+        self.logger.debug("Label updated: %r.", label)
+        self.listener(label)
+        self.rendered = monotonic()
+        stats.record('render', self.rendered - built)
+        stats.incr('renders')
+
+        # time spent waiting for the update, including the frame cap
+        for event in self.unrendered:
+            stats.record('wait', start - event.dispatched)
+            if event.received is not None:
+                stats.record('total', self.rendered - event.received)
+        self.unrendered = []
+
+
+    def _record_stats(self, events, update):
+        for event in events:
+            if event.dispatched is None:
+                continue
+            if event.processed is not None:
+                stats.record('dispatch', event.dispatched - event.processed)
+            if update:
+                self.unrendered.append(event)
+
+
+    def key_batch(self, events):
+        if events is None:
+            self.key_press(None)
+            return
+
+        # render only once for the whole batch
+        update = False
+        for event in events:
+            update |= bool(self.key_process(event))
+        self._record_stats(events, update)
+        if update:
+            self.request_update()
 
 
     def key_press(self, event):
@@ -285,6 +712,44 @@ class LabelManager(object):
             self.logger.debug("inputlistener failure: {}".format(str(self.kl.error)))
             self.listener(None)
             return
+        update = self.key_process(event)
+        self._record_stats([event], update)
+        if update:
+            self.request_update()
+
+
+    def key_process(self, event):
+        event.dispatched = monotonic()
+        self.update_stamp(event)
+        update = False
+        if event.skipped and self.enabled:
+            # keys discarded by the listener on overload
+            markup = unicode(glib.markup_escape_text(_('…{} keys').format(event.skipped)))
+            self._push(KeyData(self.stamp, True, True, True, True,
+                               '<small>' + markup + '</small>'))
+            update = True
+        # merged autorepeat is replayed at once, for a single render (a
+        # press can carry the count of the repeats folded on overload)
+        for i in range(event.count):
+            if i:
+                event.repeated = True
+            update |= bool(self.key_event(event))
+        return update
+
+
+    def update_stamp(self, event):
+        # keys are stamped with the server time (on the local monotonic
+        # clock) when known: the "recent" window starts when the key was
+        # pressed, and delays in the pipeline are part of it
+        if event.received is None:
+            stamp = event.dispatched
+        else:
+            stamp = self.server_clock.to_local(event.time, event.received)
+        # the history is kept ordered, even when the clock offset is refined
+        self.stamp = max(self.stamp, stamp)
+
+
+    def key_event(self, event):
         if event.pressed == False:
             self.logger.debug("Key released {:5}(ks): {}".format(event.keysym, event.symbol))
             return
@@ -321,23 +786,16 @@ class LabelManager(object):
                 update |= self.key_raw_mode(event)
             else:
                 update |= self.key_keysyms_mode(event)
-        if update:
-            self.update_text()
+        return update
 
 
     def key_normal_mode(self, event):
-        # Visible modifiers
-        mod = ''
-        for cap in ['ctrl', 'alt', 'super', 'hyper']:
-            if event.modifiers[cap]:
-                mod = mod + self.replace_mods[cap]
-
         # Backspace handling
         if event.symbol == 'BackSpace' and not self.mods_only and \
-           mod == '' and not event.modifiers['shift']:
+           self.mods_prefix(event, NORMAL_MODS) == '' and not event.modifiers['shift']:
             key_repl = self.replace_syms.get(event.symbol)
             if self.bak_mode == 'normal':
-                self.data.append(KeyData(datetime.now(), False, *key_repl))
+                self._push(KeyData(self.stamp, False, *key_repl))
                 return True
             else:
                 if not len(self.data):
@@ -351,11 +809,18 @@ class LabelManager(object):
                     else:
                         pop = not last.silent
                 if pop:
-                    self.data.pop()
+                    self._pop()
                 else:
-                    self.data.append(KeyData(datetime.now(), False, *key_repl))
+                    self._push(KeyData(self.stamp, False, *key_repl))
                 return True
 
+        return self.key_template(event, self._normal_template)
+
+
+    def _normal_template(self, event):
+        # Visible modifiers
+        mod = self.mods_prefix(event, NORMAL_MODS)
+
         # Regular keys
         key_repl = self.replace_syms.get(event.symbol)
         replaced = key_repl is not None
@@ -398,27 +863,24 @@ class LabelManager(object):
                     state = event.modifiers[event.symbol.lower()]
                     repl += '(%s)' % (_('off') if state else _('on'))
 
-                self.data.append(KeyData(datetime.now(), False, key_repl.bk_stop,
-                                         key_repl.silent, key_repl.spaced, repl))
-                return True
+                return (False, key_repl.bk_stop, key_repl.silent, key_repl.spaced, repl)
         else:
             if self.mods_mode == 'emacs' or key_repl.repl[0] != mod[-1]:
                 repl = mod + key_repl.repl
             else:
                 repl = mod + '‟' + key_repl.repl + '”'
-            self.data.append(KeyData(datetime.now(), True, key_repl.bk_stop,
-                                     key_repl.silent, key_repl.spaced, repl))
-            return True
+            return (True, key_repl.bk_stop, key_repl.silent, key_repl.spaced, repl)
 
         return False
 
 
     def key_raw_mode(self, event):
+        return self.key_template(event, self._raw_template)
+
+
+    def _raw_template(self, event):
         # modifiers
-        mod = ''
-        for cap in REPLACE_MODS.keys():
-            if event.modifiers[cap]:
-                mod = mod + self.replace_mods[cap]
+        mod = self.mods_prefix(event, RAW_MODS)
 
         # keycaps
         key_repl = self.replace_syms.get(event.symbol)
@@ -438,16 +900,13 @@ class LabelManager(object):
                 state = event.modifiers[event.symbol.lower()]
                 repl += '(%s)' % (_('off') if state else _('on'))
 
-            self.data.append(KeyData(datetime.now(), False, key_repl.bk_stop,
-                                     key_repl.silent, key_repl.spaced, repl))
+            return (False, key_repl.bk_stop, key_repl.silent, key_repl.spaced, repl)
         else:
             if self.mods_mode == 'emacs' or key_repl.repl[0] != mod[-1]:
                 repl = mod + key_repl.repl
             else:
                 repl = mod + '‟' + key_repl.repl + '”'
-            self.data.append(KeyData(datetime.now(), True, key_repl.bk_stop,
-                                     key_repl.silent, key_repl.spaced, repl))
-        return True
+            return (True, key_repl.bk_stop, key_repl.silent, key_repl.spaced, repl)
 
 
     def key_keysyms_mode(self, event):
@@ -455,5 +914,5 @@ class LabelManager(object):
             value = event.symbol
         else:
             value = event.string or event.symbol
-        self.data.append(KeyData(datetime.now(), True, True, True, True, value))
+        self._push(KeyData(self.stamp, True, True, True, True, value))
         return True
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+#
+# Ring of fixed-size records in an anonymous shared mapping, used to pass
+# events from the listener process to the GUI without serialization. The
+# mapping is inherited across fork(). There is a single producer and a
+# single consumer: the producer only writes the head and the consumer only
+# writes the tail, both being free-running 64-bit counters, so no locking
+# is required. Records are refused when the ring is full, leaving the
+# producer to hold or discard them. The header also carries a set of named
+# counters, written by the producer only.
+
+from __future__ import unicode_literals, absolute_import
+
+from collections import OrderedDict
+import mmap
+import struct
+
+
+# head, tail
+INDEX = struct.Struct(str('=Q'))
+INDEX_SIZE = 2 * INDEX.size
+
+
+class Ring(object):
+    def __init__(self, record, slots, counters=()):
+        self.record = record
+        self.slots = slots
+        self.counters = tuple(counters)
+        self.header = struct.Struct(str('=QQ' + 'Q' * len(self.counters)))
+        self.map = mmap.mmap(-1, self.header.size + record.size * slots)
+
+
+    def _offset(self, i):
+        return self.header.size + (i % self.slots) * self.record.size
+
+
+    def put(self, records):
+        # all the records are published at once, or none
+        head = INDEX.unpack_from(self.map, 0)[0]
+        tail = INDEX.unpack_from(self.map, INDEX.size)[0]
+        if head - tail + len(records) > self.slots:
+            return False
+        for i, values in enumerate(records):
+            self.record.pack_into(self.map, self._offset(head + i), *values)
+        INDEX.pack_into(self.map, 0, head + len(records))
+        return True
+
+
+    def get(self):
+        head = INDEX.unpack_from(self.map, 0)[0]
+        tail = INDEX.unpack_from(self.map, INDEX.size)[0]
+        ret = [self.record.unpack_from(self.map, self._offset(i))
+               for i in range(tail, head)]
+        INDEX.pack_into(self.map, INDEX.size, head)
+        return ret
+
+
+    def incr(self, name, count=1):
+        ofs = INDEX_SIZE + self.counters.index(name) * INDEX.size
+        INDEX.pack_into(self.map, ofs, INDEX.unpack_from(self.map, ofs)[0] + count)
+
+
+    def totals(self):
+        return OrderedDict(zip(self.counters, self.header.unpack_from(self.map, 0)[2:]))
+
+
+    def close(self):
+        self.map.close()
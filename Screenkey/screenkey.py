@@ -6,12 +6,16 @@
 from __future__ import print_function, unicode_literals, division
 
 from . import *
-from .labelmanager import LabelManager
+from .inputlistener import QUEUE_SIZE
+from .labelmanager import LabelManager, Label, HISTORY_SIZE
+from .stats import stats
+from .timer import Deadline, monotonic
 
-from threading import Timer
 import json
 import os
+import signal
 import subprocess
+import threading
 
 import glib
 glib.threads_init()
@@ -24,21 +28,46 @@ import pango
 import cairo
 
 
+# pango attributes of label spans kept before flushing
+SPAN_ATTRS_MAX = 1024
+
+FONT_WEIGHTS = {'regular': pango.WEIGHT_NORMAL,
+                'normal': pango.WEIGHT_NORMAL,
+                'bold': pango.WEIGHT_BOLD}
+
+
 class Screenkey(gtk.Window):
     STATE_FILE = os.path.join(glib.get_user_config_dir(), 'screenkey.json')
 
+    # options which only apply to the current session
+    TRANSIENT_OPTIONS = {'record', 'replay', 'replay_fast', 'stats', 'devices'}
+
     def __init__(self, logger, options, show_settings=False):
         gtk.Window.__init__(self, gtk.WINDOW_POPUP)
 
         self.exit_status = None
-        self.timer_hide = None
-        self.timer_min = None
+        self.labelmngr = None
+        self.span_attrs = {}
+        self.started = monotonic()
+        self.timer_hide = Deadline(self.on_timeout_main)
+        self.timer_min = Deadline(self.on_timeout_min)
         self.logger = logger
 
         defaults = Options({'no_systray': False,
                             'timeout': 2.5,
                             'recent_thr': 0.1,
                             'compr_cnt': 3,
+                            'history': HISTORY_SIZE,
+                            'compose_engine': 'xim',
+                            'translator': 'xlib',
+                            'relay': 'server',
+                            'capture': 'record',
+                            'devices': [],
+                            'loop': 'thread',
+                            'queue_size': QUEUE_SIZE,
+                            'overload': 'collapse',
+                            'render_fps': 60,
+                            'render_policy': 'latency',
                             'ignore': [],
                             'position': 'bottom',
                             'persist': False,
@@ -55,14 +84,18 @@ class Screenkey(gtk.Window):
                             'vis_shift': False,
                             'vis_space': True,
                             'geometry': None,
-                            'screen': 0})
+                            'screen': 0,
+                            'record': None,
+                            'replay': None,
+                            'replay_fast': False,
+                            'stats': False})
         self.options = self.load_state()
         if self.options is None:
             self.options = defaults
         else:
             # copy missing defaults
             for k, v in defaults.iteritems():
-                if k not in self.options:
+                if k not in self.options or k in self.TRANSIENT_OPTIONS:
                     self.options[k] = v
         if options is not None:
             # override with values from constructor
@@ -99,7 +132,6 @@ class Screenkey(gtk.Window):
         if cmap is not None:
             self.set_colormap(cmap)
 
-        self.labelmngr = None
         self.enabled = True
         self.on_change_mode()
 
@@ -111,6 +143,7 @@ class Screenkey(gtk.Window):
             self.make_systray()
 
         self.connect("delete-event", self.quit)
+        signal.signal(signal.SIGUSR1, self.on_sigusr1)
         if show_settings:
             self.on_preferences_dialog()
         if self.options.persist:
@@ -119,10 +152,23 @@ class Screenkey(gtk.Window):
 
     def quit(self, widget=None, data=None, exit_status=os.EX_OK):
         self.labelmngr.stop()
+        if self.options.stats:
+            self.dump_stats()
         self.exit_status = exit_status
         gtk.main_quit()
 
 
+    def dump_stats(self):
+        self.logger.info("Latency statistics:")
+        for line in stats.report(monotonic() - self.started):
+            self.logger.info("  " + line)
+        return False
+
+
+    def on_sigusr1(self, signum, frame):
+        glib.idle_add(self.dump_stats)
+
+
     def load_state(self):
         """Load stored options"""
         options = None
@@ -144,6 +190,7 @@ class Screenkey(gtk.Window):
 
     def store_state(self, options):
         """Store options"""
+        options = {k: v for k, v in options.items() if k not in self.TRANSIENT_OPTIONS}
         try:
             with open(self.STATE_FILE, 'w') as f:
                 json.dump(options, f)
@@ -173,11 +220,62 @@ class Screenkey(gtk.Window):
         attr.insert(pango.AttrWeight(self.font.get_weight(), 0, -1))
 
 
+    def span_attributes(self, span, level):
+        # attributes of unchanged spans are built only once
+        key = (span, level)
+        ret = self.span_attrs.get(key)
+        if ret is not None:
+            return ret
+        if len(self.span_attrs) >= SPAN_ATTRS_MAX:
+            self.span_attrs.clear()
+        ret = []
+        if span.tag == 'u':
+            ret.append(pango.AttrUnderline(pango.UNDERLINE_SINGLE, span.start, span.end))
+        elif span.tag == 'sub':
+            ret.append(pango.AttrRise(-5000, span.start, span.end))
+            ret.append(pango.AttrScale(pango.SCALE_SMALL ** level, span.start, span.end))
+        elif span.tag == 'small':
+            ret.append(pango.AttrScale(pango.SCALE_SMALL ** level, span.start, span.end))
+        elif span.tag == 'span':
+            for k, v in span.attrs:
+                if k == 'font_family':
+                    ret.append(pango.AttrFamily(v, span.start, span.end))
+                elif k == 'font_weight':
+                    ret.append(pango.AttrWeight(FONT_WEIGHTS[v], span.start, span.end))
+        self.span_attrs[key] = ret
+        return ret
+
+
+    def label_attributes(self, label):
+        attr = pango.AttrList()
+        scaled = []
+        for span in label.spans:
+            # nested sub/small tags compound their scale
+            while scaled and scaled[-1] <= span.start:
+                scaled.pop()
+            if span.tag in ('sub', 'small'):
+                scaled.append(span.end)
+            for a in self.span_attributes(span, len(scaled)):
+                attr.insert(a)
+        return attr
+
+
     def update_label(self):
         attr = self.label.get_attributes()
         text = self.label.get_text()
         self.override_font_attributes(attr, text)
         self.label.set_attributes(attr)
+        self.update_history_width()
+
+
+    def update_history_width(self):
+        if self.labelmngr is None:
+            return
+        # assume no key is narrower than a quarter of an em
+        window_width, window_height = self.get_size()
+        font_px = 50 * window_height // 100
+        if font_px > 0:
+            self.labelmngr.set_width(4 * window_width // font_px + 1)
 
 
     def update_colors(self):
@@ -269,27 +367,27 @@ class Screenkey(gtk.Window):
         self.quit(exit_status=os.EX_SOFTWARE)
 
 
-    def on_label_change(self, markup):
-        if markup is None:
+    def on_label_change(self, label):
+        if label is None:
             self.on_labelmngr_error()
             return
 
-        attr, text, _ = pango.parse_markup(markup)
-        self.override_font_attributes(attr, text)
-        self.label.set_text(text)
+        attr = self.label_attributes(label)
+        self.override_font_attributes(attr, label.text)
+        self.label.set_text(label.text)
         self.label.set_attributes(attr)
 
         if not self.get_property('visible'):
             self.show()
-        if self.timer_hide:
-            self.timer_hide.cancel()
         if self.options.timeout > 0:
-            self.timer_hide = Timer(self.options.timeout, self.on_timeout_main)
-            self.timer_hide.start()
-        if self.timer_min:
-            self.timer_min.cancel()
-        self.timer_min = Timer(self.options.recent_thr * 2, self.on_timeout_min)
-        self.timer_min.start()
+            self.timer_hide.start(self.options.timeout)
+        else:
+            self.timer_hide.cancel()
+        self.timer_min.start(self.options.recent_thr * 2)
+        self.logger.debug("Timers re-armed: %s times, %s sources, %s threads.",
+                          self.timer_hide.rearms + self.timer_min.rearms,
+                          self.timer_hide.sources + self.timer_min.sources,
+                          threading.active_count())
 
 
     def on_timeout_main(self):
@@ -320,7 +418,22 @@ class Screenkey(gtk.Window):
                                       recent_thr=self.options.recent_thr,
                                       compr_cnt=self.options.compr_cnt,
                                       ignore=self.options.ignore,
-                                      pango_ctx=self.label.get_pango_context())
+                                      pango_ctx=self.label.get_pango_context(),
+                                      history=self.options.history,
+                                      compose_engine=self.options.compose_engine,
+                                      translator=self.options.translator,
+                                      relay=self.options.relay,
+                                      capture=self.options.capture,
+                                      devices=self.options.devices,
+                                      loop=self.options.loop,
+                                      queue_size=self.options.queue_size,
+                                      overload=self.options.overload,
+                                      render_fps=self.options.render_fps,
+                                      render_policy=self.options.render_policy,
+                                      record=self.options.record,
+                                      replay=self.options.replay,
+                                      replay_fast=self.options.replay_fast)
+        self.update_history_width()
         self.labelmngr.start()
 
 
@@ -423,7 +536,7 @@ class Screenkey(gtk.Window):
             if not self.get_property('visible'):
                 self.show()
             else:
-                self.on_label_change(self.label.get_text())
+                self.on_label_change(Label(self.label.get_text(), []))
             self.logger.debug("Persistent changed: %s." % self.options.persist)
 
         def on_sb_compr_changed(widget, data=None):
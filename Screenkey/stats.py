@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+#
+# In-memory performance counters, shared by the listener thread and the main
+# loop. Latencies are kept in log-scale histograms (four buckets per octave,
+# starting from one microsecond) so that memory usage is constant.
+
+from __future__ import unicode_literals, division
+
+from collections import OrderedDict
+import math
+import threading
+
+
+BUCKETS_PER_OCTAVE = 4
+BUCKETS = 26 * BUCKETS_PER_OCTAVE
+BUCKET_MIN = 1e-6
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+
+    def add(self, value):
+        if value < 0.:
+            value = 0.
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value <= BUCKET_MIN:
+            i = 0
+        else:
+            i = min(BUCKETS - 1, int(math.log(value / BUCKET_MIN, 2) * BUCKETS_PER_OCTAVE) + 1)
+        self.buckets[i] += 1
+
+
+    def percentile(self, p):
+        # upper bound of the bucket containing the requested percentile
+        rank = p * self.count
+        acc = 0
+        for i, n in enumerate(self.buckets):
+            acc += n
+            if acc >= rank and n:
+                return min(self.max, BUCKET_MIN * 2 ** (i / BUCKETS_PER_OCTAVE))
+        return self.max
+
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean': self.total / self.count,
+                'p50': self.percentile(0.50),
+                'p90': self.percentile(0.90),
+                'p99': self.percentile(0.99),
+                'max': self.max}
+
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.histograms = OrderedDict()
+            self.counters = OrderedDict()
+
+
+    def record(self, name, value):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.add(value)
+
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+
+    def report(self, elapsed=None):
+        with self.lock:
+            lines = []
+            for name, hist in self.histograms.items():
+                s = hist.summary()
+                if not s['count']:
+                    continue
+                lines.append("{:20} n={:<8} mean={:.3f}ms p50={:.3f}ms p90={:.3f}ms "
+                             "p99={:.3f}ms max={:.3f}ms".format(
+                                 name, s['count'], s['mean'] * 1e3, s['p50'] * 1e3,
+                                 s['p90'] * 1e3, s['p99'] * 1e3, s['max'] * 1e3))
+            for name, value in self.counters.items():
+                if elapsed:
+                    lines.append("{:20} {} ({:.1f}/s)".format(name, value, value / elapsed))
+                else:
+                    lines.append("{:20} {}".format(name, value))
+            return lines
+
+
+# process-wide instance
+stats = Stats()
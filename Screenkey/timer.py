@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+
+from __future__ import unicode_literals, absolute_import, division
+
+import sys
+if sys.version_info.major < 3:
+    import glib
+else:
+    from gi.repository import GLib as glib
+
+import ctypes
+import ctypes.util
+
+
+# monotonic clock (time.monotonic is not available in python 2)
+try:
+    from time import monotonic
+except ImportError:
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long),
+                    ('tv_nsec', ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    _clock_gettime.restype = ctypes.c_int
+
+    def monotonic():
+        ts = _timespec()
+        _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+
+class Deadline(object):
+    """Main-loop timer which can be re-armed cheaply.
+
+    Re-arming only moves the deadline: a single GLib timeout source is kept
+    pending and is rescheduled when it expires too early, so that frequent
+    updates (such as one per keystroke) do not create/destroy sources or
+    threads. The callback is always run in the main loop."""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.deadline = None
+        self.source = None
+        self.source_deadline = None
+        self.sources = 0
+        self.rearms = 0
+
+
+    def start(self, timeout):
+        self.deadline = monotonic() + timeout
+        self.rearms += 1
+        if self.source is not None and self.source_deadline > self.deadline:
+            # pending source would fire too late
+            glib.source_remove(self.source)
+            self.source = None
+        if self.source is None:
+            self._arm(timeout)
+
+
+    def cancel(self):
+        self.deadline = None
+        if self.source is not None:
+            glib.source_remove(self.source)
+            self.source = None
+
+
+    def pending(self):
+        return self.deadline is not None
+
+
+    def _arm(self, timeout):
+        self.sources += 1
+        self.source_deadline = self.deadline
+        self.source = glib.timeout_add(max(0, int(timeout * 1000 + 0.5)), self._expired)
+
+
+    def _expired(self):
+        self.source = None
+        if self.deadline is None:
+            return False
+        left = self.deadline - monotonic()
+        if left > 0.001:
+            self._arm(left)
+            return False
+        self.deadline = None
+        self.callback()
+        return False
+
+
+
+class ServerClock(object):
+    """Map X server timestamps to the local monotonic clock.
+
+    Server time is in milliseconds and wraps around every ~49 days. A local
+    server on Linux uses the same monotonic clock, in which case no offset is
+    applied. Otherwise the offset is estimated as the smallest difference
+    observed between the local reception time and the server time."""
+
+    WRAP = 1 << 32
+    SHARED_THR = 1.
+
+    def __init__(self):
+        self.offset = None
+        self.shared = None
+        self.epoch = 0
+        self.last = None
+
+
+    def to_local(self, server_time, received):
+        if self.last is not None and server_time < self.last - self.WRAP // 2:
+            self.epoch += self.WRAP
+        self.last = server_time
+        server = (server_time + self.epoch) / 1000.
+
+        diff = received - server
+        if self.shared is None:
+            self.shared = abs(diff) < self.SHARED_THR
+            self.offset = 0. if self.shared else diff
+        elif not self.shared and diff < self.offset:
+            self.offset = diff
+        return server + self.offset
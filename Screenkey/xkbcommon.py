@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+#
+# Minimal ctypes bindings to libxkbcommon(-x11), used to translate keys
+# without an input method. The keymap is fetched from the server once (and
+# again on mapping changes only): lookups do not generate any traffic.
+
+from __future__ import unicode_literals, absolute_import
+
+from ctypes import *
+
+try:
+    libxkbcommon = CDLL('libxkbcommon.so.0')
+    libxkbcommon_x11 = CDLL('libxkbcommon-x11.so.0')
+    libX11_xcb = CDLL('libX11-xcb.so.1')
+    available = True
+except OSError:
+    available = False
+
+
+class XkbError(Exception):
+    pass
+
+
+if available:
+    # constants
+    XKB_CONTEXT_NO_FLAGS = 0
+    XKB_KEYMAP_COMPILE_NO_FLAGS = 0
+    XKB_X11_SETUP_XKB_EXTENSION_NO_FLAGS = 0
+    XKB_X11_MIN_MAJOR_XKB_VERSION = 1
+    XKB_X11_MIN_MINOR_XKB_VERSION = 0
+
+    # functions
+    XGetXCBConnection = libX11_xcb.XGetXCBConnection
+    XGetXCBConnection.argtypes = [c_void_p]
+    XGetXCBConnection.restype = c_void_p
+
+    xkb_context_new = libxkbcommon.xkb_context_new
+    xkb_context_new.argtypes = [c_int]
+    xkb_context_new.restype = c_void_p
+
+    xkb_context_unref = libxkbcommon.xkb_context_unref
+    xkb_context_unref.argtypes = [c_void_p]
+    xkb_context_unref.restype = None
+
+    xkb_keymap_unref = libxkbcommon.xkb_keymap_unref
+    xkb_keymap_unref.argtypes = [c_void_p]
+    xkb_keymap_unref.restype = None
+
+    xkb_state_new = libxkbcommon.xkb_state_new
+    xkb_state_new.argtypes = [c_void_p]
+    xkb_state_new.restype = c_void_p
+
+    xkb_state_unref = libxkbcommon.xkb_state_unref
+    xkb_state_unref.argtypes = [c_void_p]
+    xkb_state_unref.restype = None
+
+    xkb_state_update_mask = libxkbcommon.xkb_state_update_mask
+    xkb_state_update_mask.argtypes = [c_void_p, c_uint32, c_uint32, c_uint32,
+                                      c_uint32, c_uint32, c_uint32]
+    xkb_state_update_mask.restype = c_int
+
+    xkb_state_key_get_one_sym = libxkbcommon.xkb_state_key_get_one_sym
+    xkb_state_key_get_one_sym.argtypes = [c_void_p, c_uint32]
+    xkb_state_key_get_one_sym.restype = c_uint32
+
+    xkb_state_key_get_utf8 = libxkbcommon.xkb_state_key_get_utf8
+    xkb_state_key_get_utf8.argtypes = [c_void_p, c_uint32, c_char_p, c_size_t]
+    xkb_state_key_get_utf8.restype = c_int
+
+    xkb_x11_setup_xkb_extension = libxkbcommon_x11.xkb_x11_setup_xkb_extension
+    xkb_x11_setup_xkb_extension.argtypes = [c_void_p, c_uint16, c_uint16, c_int,
+                                            POINTER(c_uint16), POINTER(c_uint16),
+                                            POINTER(c_uint8), POINTER(c_uint8)]
+    xkb_x11_setup_xkb_extension.restype = c_int
+
+    xkb_x11_get_core_keyboard_device_id = libxkbcommon_x11.xkb_x11_get_core_keyboard_device_id
+    xkb_x11_get_core_keyboard_device_id.argtypes = [c_void_p]
+    xkb_x11_get_core_keyboard_device_id.restype = c_int32
+
+    xkb_x11_keymap_new_from_device = libxkbcommon_x11.xkb_x11_keymap_new_from_device
+    xkb_x11_keymap_new_from_device.argtypes = [c_void_p, c_void_p, c_int32, c_int]
+    xkb_x11_keymap_new_from_device.restype = c_void_p
+
+
+
+class Translator(object):
+    """Keycode translation using the keymap of the core keyboard. The state
+    is set from the modifier/group mask of each event."""
+
+    def __init__(self, dpy):
+        self.conn = XGetXCBConnection(cast(dpy, c_void_p))
+        if not xkb_x11_setup_xkb_extension(self.conn, XKB_X11_MIN_MAJOR_XKB_VERSION,
+                                           XKB_X11_MIN_MINOR_XKB_VERSION,
+                                           XKB_X11_SETUP_XKB_EXTENSION_NO_FLAGS,
+                                           None, None, None, None):
+            raise XkbError("XKB extension not available")
+        self.device = xkb_x11_get_core_keyboard_device_id(self.conn)
+        if self.device < 0:
+            raise XkbError("cannot find the core keyboard")
+        self.ctx = xkb_context_new(XKB_CONTEXT_NO_FLAGS)
+        if not self.ctx:
+            raise XkbError("cannot create the xkb context")
+        self.keymap = None
+        self.state = None
+        self.mask = None
+        self.buf = create_string_buffer(64)
+        self.reload()
+
+
+    def reload(self):
+        keymap = xkb_x11_keymap_new_from_device(self.ctx, self.conn, self.device,
+                                                XKB_KEYMAP_COMPILE_NO_FLAGS)
+        if not keymap:
+            raise XkbError("cannot load the keymap")
+        state = xkb_state_new(keymap)
+        if not state:
+            xkb_keymap_unref(keymap)
+            raise XkbError("cannot create the keyboard state")
+        self._release()
+        self.keymap = keymap
+        self.state = state
+        self.mask = None
+
+
+    def lookup(self, keycode, mask):
+        """Return the keysym and UTF-8 string (or None) of keycode"""
+        if mask != self.mask:
+            # the core state has the real modifiers and the effective group
+            xkb_state_update_mask(self.state, mask & 0xff, 0, 0, 0, 0, (mask >> 13) & 3)
+            self.mask = mask
+        keysym = xkb_state_key_get_one_sym(self.state, keycode)
+        if xkb_state_key_get_utf8(self.state, keycode, self.buf, len(self.buf)) <= 0:
+            return keysym, None
+        return keysym, self.buf.value.decode('utf-8', 'replace')
+
+
+    def _release(self):
+        if self.state is not None:
+            xkb_state_unref(self.state)
+            self.state = None
+        if self.keymap is not None:
+            xkb_keymap_unref(self.keymap)
+            self.keymap = None
+
+
+    def close(self):
+        self._release()
+        if self.ctx is not None:
+            xkb_context_unref(self.ctx)
+            self.ctx = None
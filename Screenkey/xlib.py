@@ -28,6 +28,13 @@ class Display(Structure):
 class Visual(Structure):
     pass
 
+class XAnyEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('window', Window)]
+
 class XKeyEvent(Structure):
     _fields_ = [('type', c_int),
                 ('serial', c_ulong),
@@ -92,12 +99,85 @@ class XClientMessageEvent(Structure):
                 ('format', c_int),
                 ('data', c_long * 5)]
 
+class XMappingEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('window', Window),
+                ('request', c_int),
+                ('first_keycode', c_int),
+                ('count', c_int)]
+
+class XPropertyEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('window', Window),
+                ('atom', Atom),
+                ('time', Time),
+                ('state', c_int)]
+
+class XGenericEventCookie(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('extension', c_int),
+                ('evtype', c_int),
+                ('cookie', c_uint),
+                ('data', c_void_p)]
+
+class XkbAnyEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('time', Time),
+                ('xkb_type', c_int),
+                ('device', c_uint)]
+
+class XkbStateNotifyEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('time', Time),
+                ('xkb_type', c_int),
+                ('device', c_int),
+                ('changed', c_uint),
+                ('group', c_int),
+                ('base_group', c_int),
+                ('latched_group', c_int),
+                ('locked_group', c_int),
+                ('mods', c_uint),
+                ('base_mods', c_uint),
+                ('latched_mods', c_uint),
+                ('locked_mods', c_uint),
+                ('compat_state', c_int),
+                ('grab_mods', c_ubyte),
+                ('compat_grab_mods', c_ubyte),
+                ('lookup_mods', c_ubyte),
+                ('compat_lookup_mods', c_ubyte),
+                ('ptr_buttons', c_int),
+                ('keycode', KeyCode),
+                ('event_type', c_char),
+                ('req_major', c_char),
+                ('req_minor', c_char)]
+
 class XEvent(Union):
     _fields_ = [('type', c_int),
+                ('xany', XAnyEvent),
                 ('xkey', XKeyEvent),
                 ('xbutton', XButtonEvent),
                 ('xmotion', XMotionEvent),
                 ('xclient', XClientMessageEvent),
+                ('xmapping', XMappingEvent),
+                ('xproperty', XPropertyEvent),
+                ('xcookie', XGenericEventCookie),
+                ('xkb', XkbAnyEvent),
+                ('xkbstate', XkbStateNotifyEvent),
                 ('pad', c_long * 24)]
 
 class XSetWindowAttributes(Structure):
@@ -126,13 +206,22 @@ ButtonRelease = 5
 MotionNotify = 6
 FocusIn = 9
 FocusOut = 10
+PropertyNotify = 28
 ClientMessage = 33
+MappingNotify = 34
+GenericEvent = 35
+
+MappingModifier = 0
+MappingKeyboard = 1
+MappingPointer = 2
 
 CopyFromParent = 0
 InputOnly = 2
 
 CWOverrideRedirect = (1<<9)
 
+PropertyChangeMask = (1<<22)
+
 ShiftMask = (1<<0)
 LockMask = (1<<1)
 ControlMask = (1<<2)
@@ -196,6 +285,22 @@ XPending = libX11.XPending
 XPending.argtypes = [POINTER(Display)]
 XPending.restype = c_int
 
+XSelectInput = libX11.XSelectInput
+XSelectInput.argtypes = [POINTER(Display), Window, c_long]
+XSelectInput.restype = c_int
+
+XQueryExtension = libX11.XQueryExtension
+XQueryExtension.argtypes = [POINTER(Display), String, POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+XQueryExtension.restype = Bool
+
+XGetEventData = libX11.XGetEventData
+XGetEventData.argtypes = [POINTER(Display), POINTER(XGenericEventCookie)]
+XGetEventData.restype = Bool
+
+XFreeEventData = libX11.XFreeEventData
+XFreeEventData.argtypes = [POINTER(Display), POINTER(XGenericEventCookie)]
+XFreeEventData.restype = None
+
 XSynchronize = libX11.XSynchronize
 XSynchronize.argtypes = [POINTER(Display), c_int]
 XSynchronize.restype = POINTER(CFUNCTYPE(c_int, POINTER(Display)))
@@ -268,6 +373,10 @@ Xutf8LookupString = libX11.Xutf8LookupString
 Xutf8LookupString.argtypes = [XIC, POINTER(XKeyPressedEvent), String, c_int, POINTER(KeySym), POINTER(c_int)]
 Xutf8LookupString.restype = c_int
 
+XLookupString = libX11.XLookupString
+XLookupString.argtypes = [POINTER(XKeyEvent), String, c_int, POINTER(KeySym), c_void_p]
+XLookupString.restype = c_int
+
 XKeysymToString = libX11.XKeysymToString
 XKeysymToString.argtypes = [KeySym]
 XKeysymToString.restype = String
@@ -276,6 +385,127 @@ XkbKeycodeToKeysym = libX11.XkbKeycodeToKeysym
 XkbKeycodeToKeysym.argtypes = [POINTER(Display), KeyCode, c_uint, c_uint]
 XkbKeycodeToKeysym.restype = KeySym
 
+XStringToKeysym = libX11.XStringToKeysym
+XStringToKeysym.argtypes = [String]
+XStringToKeysym.restype = KeySym
+
+XKeysymToKeycode = libX11.XKeysymToKeycode
+XKeysymToKeycode.argtypes = [POINTER(Display), KeySym]
+XKeysymToKeycode.restype = KeyCode
+
+XDisplayKeycodes = libX11.XDisplayKeycodes
+XDisplayKeycodes.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int)]
+XDisplayKeycodes.restype = c_int
+
+XGetKeyboardMapping = libX11.XGetKeyboardMapping
+XGetKeyboardMapping.argtypes = [POINTER(Display), KeyCode, c_int, POINTER(c_int)]
+XGetKeyboardMapping.restype = POINTER(KeySym)
+
+XRefreshKeyboardMapping = libX11.XRefreshKeyboardMapping
+XRefreshKeyboardMapping.argtypes = [POINTER(XMappingEvent)]
+XRefreshKeyboardMapping.restype = c_int
+
+
+## xkb
+# constants
+XkbMajorVersion = 1
+XkbMinorVersion = 0
+
+XkbUseCoreKbd = 0x0100
+
+XkbNewKeyboardNotify = 0
+XkbMapNotify = 1
+XkbStateNotify = 2
+
+XkbNewKeyboardNotifyMask = (1<<0)
+XkbMapNotifyMask = (1<<1)
+XkbStateNotifyMask = (1<<2)
+
+# types
+class XkbStateRec(Structure):
+    _fields_ = [('group', c_ubyte),
+                ('locked_group', c_ubyte),
+                ('base_group', c_ushort),
+                ('latched_group', c_ushort),
+                ('mods', c_ubyte),
+                ('base_mods', c_ubyte),
+                ('latched_mods', c_ubyte),
+                ('locked_mods', c_ubyte),
+                ('compat_state', c_ubyte),
+                ('grab_mods', c_ubyte),
+                ('compat_grab_mods', c_ubyte),
+                ('lookup_mods', c_ubyte),
+                ('compat_lookup_mods', c_ubyte),
+                ('ptr_buttons', c_ushort)]
+
+# functions
+XkbQueryExtension = libX11.XkbQueryExtension
+XkbQueryExtension.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+XkbQueryExtension.restype = Bool
+
+XkbSelectEvents = libX11.XkbSelectEvents
+XkbSelectEvents.argtypes = [POINTER(Display), c_uint, c_ulong, c_ulong]
+XkbSelectEvents.restype = Bool
+
+XkbGetState = libX11.XkbGetState
+XkbGetState.argtypes = [POINTER(Display), c_uint, POINTER(XkbStateRec)]
+XkbGetState.restype = Status
+
+
+## xinput2 (optional: only required for raw capture)
+try:
+    libXi = CDLL('libXi.so.6')
+    xi2_available = True
+except OSError:
+    xi2_available = False
+
+# types
+class XIEventMask(Structure):
+    _fields_ = [('deviceid', c_int),
+                ('mask_len', c_int),
+                ('mask', POINTER(c_ubyte))]
+
+class XIValuatorState(Structure):
+    _fields_ = [('mask_len', c_int),
+                ('mask', POINTER(c_ubyte)),
+                ('values', POINTER(c_double))]
+
+class XIRawEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('extension', c_int),
+                ('evtype', c_int),
+                ('time', Time),
+                ('deviceid', c_int),
+                ('sourceid', c_int),
+                ('detail', c_int),
+                ('flags', c_int),
+                ('valuators', XIValuatorState),
+                ('raw_values', POINTER(c_double))]
+
+# constants
+XIAllDevices = 0
+XIAllMasterDevices = 1
+
+XI_RawKeyPress = 13
+XI_RawKeyRelease = 14
+XI_RawButtonPress = 15
+XI_RawButtonRelease = 16
+XI_RawMotion = 17
+XI_LASTEVENT = XI_RawMotion
+
+# functions
+if xi2_available:
+    XIQueryVersion = libXi.XIQueryVersion
+    XIQueryVersion.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int)]
+    XIQueryVersion.restype = Status
+
+    XISelectEvents = libXi.XISelectEvents
+    XISelectEvents.argtypes = [POINTER(Display), Window, POINTER(XIEventMask), c_int]
+    XISelectEvents.restype = c_int
+
 
 ## record extensions
 libXtst = CDLL('libXtst.so.6')
@@ -354,6 +584,16 @@ XRecordFreeData.argtypes = [POINTER(XRecordInterceptData)]
 XRecordFreeData.restype = None
 
 
+## xtest extension (used for benchmarking)
+XTestQueryExtension = libXtst.XTestQueryExtension
+XTestQueryExtension.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+XTestQueryExtension.restype = Bool
+
+XTestFakeKeyEvent = libXtst.XTestFakeKeyEvent
+XTestFakeKeyEvent.argtypes = [POINTER(Display), c_uint, Bool, c_ulong]
+XTestFakeKeyEvent.restype = c_int
+
+
 ## wire protocol
 CARD8 = c_ubyte
 CARD16 = c_ushort
@@ -456,3 +696,49 @@ def XWireToEvent(dpy, data):
     elif wev.u.type == MotionNotify:
         return _mtn_wire_to_event(dpy, wev)
     return XEvent(wev.u.type)
+
+
+# Fast path for XRecord data: the wire event is unpacked with a single call
+# and packed directly into a reused XEvent, using the native layout of the
+# (identical) key/button and motion event structures.
+import struct
+
+_WIRE_INPUT = struct.Struct(str('=BBHIIIIhhhhHBx'))
+_XKEY_EVENT = struct.Struct(str('@iLiPLLLLiiiiIIi'))
+_XMOTION_EVENT = struct.Struct(str('@iLiPLLLLiiiiIBi'))
+
+class WireDecoder(object):
+    def __init__(self, dpy):
+        self.dpy = cast(dpy, c_void_p).value
+        self.event = XEvent()
+
+
+    def decode(self, data):
+        # the returned event is only valid until the next call
+        ev = self.event
+        (ev_type, detail, serial, time, root, window, child,
+         x_root, y_root, x, y, state, same_screen) = \
+            _WIRE_INPUT.unpack(string_at(data, _WIRE_INPUT.size))
+        if ev_type in (KeyPress, KeyRelease, ButtonPress, ButtonRelease):
+            layout = _XKEY_EVENT
+        elif ev_type == MotionNotify:
+            layout = _XMOTION_EVENT
+        else:
+            memset(byref(ev), 0, sizeof(ev))
+            ev.type = ev_type
+            return ev
+        layout.pack_into(ev, 0, ev_type, serial, (ev_type & 0x80) != 0, self.dpy,
+                         window, root, child, time, x, y, x_root, y_root,
+                         state, detail, same_screen)
+        return ev
+
+
+def XEventToWire(ev):
+    # inverse of WireDecoder.decode, for capture files
+    if KeyPress <= ev.type <= MotionNotify:
+        k = ev.xkey
+        detail = ev.xmotion.is_hint if ev.type == MotionNotify else k.keycode
+        return _WIRE_INPUT.pack(k.type, detail, k.serial & 0xffff, k.time, k.root, k.window,
+                                k.subwindow, k.x_root, k.y_root, k.x, k.y, k.state,
+                                k.same_screen)
+    return _WIRE_INPUT.pack(ev.type, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+#
+# Headless LabelManager benchmark: synthetic key streams are fed directly to
+# LabelManager.key_press, without any display server or GTK. Each scenario
+# runs in a forked process to measure its peak memory in isolation. Results
+# are written as JSON.
+
+from __future__ import print_function, unicode_literals, division
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Screenkey import VERSION, BAK_MODES, MODS_MODES
+from Screenkey.inputlistener import KeyData, MODIFIERS, MODIFIER_MASKS
+from Screenkey.labelmanager import LabelManager
+
+from argparse import ArgumentParser
+import json
+import logging
+import platform
+import random
+import resource
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+TIMED_METHODS = ['update_text', 'key_normal_mode', 'key_raw_mode', 'key_keysyms_mode']
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+class FakePangoContext(object):
+    def list_families(self):
+        return []
+
+
+def key(symbol, string=None, mods=(), repeated=False, pressed=True):
+    mask = 0
+    for name, bit in MODIFIER_MASKS:
+        if name in mods:
+            mask |= bit
+    return KeyData(pressed=pressed, filtered=False, repeated=repeated,
+                   string=string, keysym=0, status=0, symbol=symbol,
+                   mods_mask=mask, modifiers=MODIFIERS[mask])
+
+
+def letter(rng):
+    c = rng.choice(LETTERS)
+    return key(c, c)
+
+
+# synthetic streams
+def stream_typing(rng, count):
+    for i in range(count):
+        if rng.random() < 0.15:
+            yield key('space', ' ')
+        else:
+            yield letter(rng)
+
+
+def stream_autorepeat(rng, count):
+    symbols = [('Right', None), ('Left', None), ('a', 'a'), ('BackSpace', None)]
+    i = 0
+    while i < count:
+        symbol, string = rng.choice(symbols)
+        for n in range(min(rng.randint(10, 200), count - i)):
+            yield key(symbol, string, repeated=(n != 0))
+            i += 1
+
+
+def stream_backspace(rng, count):
+    for i in range(count):
+        if rng.random() < 0.4:
+            yield key('BackSpace')
+        elif rng.random() < 0.1:
+            yield key('Left')
+        else:
+            yield letter(rng)
+
+
+def stream_chords(rng, count):
+    mods = [('ctrl',), ('alt',), ('super',), ('ctrl', 'shift'), ('ctrl', 'alt'), ('hyper',)]
+    for i in range(count):
+        if rng.random() < 0.5:
+            yield key('Control_L', None, ('ctrl',))
+        c = rng.choice(LETTERS)
+        yield key(c, c, rng.choice(mods))
+
+
+def stream_multiline(rng, count):
+    for i in range(count):
+        if rng.random() < 0.1:
+            yield key('Return', '\r')
+        else:
+            yield letter(rng)
+
+
+def scenarios():
+    ret = []
+    for key_mode in ['composed', 'raw', 'keysyms']:
+        ret.append(('typing-' + key_mode, stream_typing, {'key_mode': key_mode}))
+        ret.append(('autorepeat-' + key_mode, stream_autorepeat, {'key_mode': key_mode}))
+    for bak_mode in sorted(BAK_MODES):
+        ret.append(('backspace-' + bak_mode, stream_backspace, {'bak_mode': bak_mode}))
+    for mods_mode in sorted(MODS_MODES):
+        ret.append(('chords-' + mods_mode, stream_chords, {'mods_mode': mods_mode}))
+    ret.append(('multiline', stream_multiline, {'multiline': True, 'vis_space': False}))
+    return ret
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'calls': 0}
+    def pct(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))] * 1e6
+    return {'calls': len(samples),
+            'mean_us': sum(samples) / len(samples) * 1e6,
+            'p50_us': pct(0.50),
+            'p90_us': pct(0.90),
+            'p99_us': pct(0.99),
+            'max_us': samples[-1] * 1e6}
+
+
+def history_bytes(data):
+    # stored keys and their stamps, shared markup being counted once
+    total = 0
+    markups = set()
+    for key in data:
+        total += sys.getsizeof(key) + sys.getsizeof(key.stamp)
+        if id(key.markup) not in markups:
+            markups.add(id(key.markup))
+            total += sys.getsizeof(key.markup)
+    return total
+
+
+def timed(func, samples):
+    clock = time.time
+    def wrapper(*args, **kwargs):
+        start = clock()
+        ret = func(*args, **kwargs)
+        samples.append(clock() - start)
+        return ret
+    return wrapper
+
+
+def run_scenario(stream, settings, args):
+    options = {'key_mode': 'composed',
+               'bak_mode': 'baked',
+               'mods_mode': 'normal',
+               'mods_only': False,
+               'multiline': False,
+               'vis_shift': False,
+               'vis_space': True,
+               'recent_thr': 0.1,
+               'compr_cnt': 3,
+               'ignore': [],
+               'history': args.history}
+    options.update(settings)
+
+    renders = [0]
+    def listener(label):
+        renders[0] += 1
+
+    logger = logging.getLogger('bench')
+    lm = LabelManager(listener, logger, pango_ctx=FakePangoContext(), **options)
+    samples = {}
+    for name in TIMED_METHODS:
+        samples[name] = []
+        setattr(lm, name, timed(getattr(lm, name), samples[name]))
+
+    events = list(stream(random.Random(args.seed), args.events))
+    latency = []
+    rss_base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    start = time.time()
+    for event in events:
+        t = time.time()
+        lm.key_press(event)
+        latency.append(time.time() - t)
+    elapsed = time.time() - start
+
+    ret = {'settings': options,
+           'events': len(events),
+           'renders': renders[0],
+           'history': len(lm.data),
+           'history_bytes_per_key': history_bytes(lm.data) / len(lm.data) if len(lm.data) else None,
+           'elapsed_s': elapsed,
+           'events_per_sec': len(events) / elapsed if elapsed else None,
+           'key_press': percentiles(latency),
+           'methods': {k: percentiles(v) for k, v in samples.items()},
+           'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_base}
+    if tracemalloc is not None:
+        ret['peak_alloc_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return ret
+
+
+def run_forked(stream, settings, args):
+    # run each scenario in a child to isolate peak memory usage
+    rd, wr = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rd)
+        try:
+            ret = run_scenario(stream, settings, args)
+        except Exception as e:
+            ret = {'error': repr(e)}
+        with os.fdopen(wr, 'w') as fd:
+            json.dump(ret, fd)
+        os._exit(0)
+    os.close(wr)
+    with os.fdopen(rd, 'r') as fd:
+        ret = json.load(fd)
+    os.waitpid(pid, 0)
+    return ret
+
+
+def main():
+    ap = ArgumentParser(description="Headless LabelManager benchmark")
+    ap.add_argument('-n', '--events', type=int, default=20000,
+                    help="number of events per scenario")
+    ap.add_argument('-s', '--seed', type=int, default=0,
+                    help="random seed of the synthetic streams")
+    ap.add_argument('--history', type=int, default=0,
+                    help="history limit (0 for unlimited)")
+    ap.add_argument('-k', '--filter', default='',
+                    help="run only the scenarios containing this string")
+    ap.add_argument('-o', '--output', help="output file (default: stdout)")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {'version': VERSION,
+               'python': platform.python_version(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'events': args.events,
+               'seed': args.seed,
+               'scenarios': {}}
+    for name, stream, settings in scenarios():
+        if args.filter not in name:
+            continue
+        print("running {}...".format(name), file=sys.stderr)
+        results['scenarios'][name] = run_forked(stream, settings, args)
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
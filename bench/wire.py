@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+#
+# Wire event decoding microbenchmark: compares the generic XWireToEvent
+# conversion with the WireDecoder used by the listener on synthetic XRecord
+# data. No display connection is required. Results are written as JSON.
+
+from __future__ import print_function, unicode_literals, division
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Screenkey import VERSION, xlib
+
+from argparse import ArgumentParser
+import json
+import platform
+import random
+import time
+import timeit
+
+
+EVENT_TYPES = {'key': [xlib.KeyPress, xlib.KeyRelease],
+               'button': [xlib.ButtonPress, xlib.ButtonRelease],
+               'motion': [xlib.MotionNotify]}
+
+
+def wire_events(rng, types, count):
+    events = []
+    for i in range(count):
+        data = (xlib.c_ubyte * 32)(*[rng.randrange(256) for _ in range(32)])
+        data[0] = rng.choice(types)
+        events.append(data)
+    return events
+
+
+def check(dpy, events):
+    # both decoders must agree on every field which is relayed
+    decoder = xlib.WireDecoder(dpy)
+    for data in events:
+        a = xlib.XWireToEvent(dpy, data).xkey
+        b = decoder.decode(data).xkey
+        for name, _ in xlib.XKeyEvent._fields_:
+            if name != 'display' and getattr(a, name) != getattr(b, name):
+                raise AssertionError("decoders differ on {}".format(name))
+
+
+def measure(func, events, repeat):
+    def run():
+        for data in events:
+            func(data)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return best / len(events)
+
+
+def main():
+    ap = ArgumentParser(description="Wire event decoding microbenchmark")
+    ap.add_argument('-n', '--events', type=int, default=10000,
+                    help="number of events per run")
+    ap.add_argument('-r', '--repeat', type=int, default=5,
+                    help="number of runs (the best is kept)")
+    ap.add_argument('-s', '--seed', type=int, default=0,
+                    help="random seed of the synthetic events")
+    ap.add_argument('-o', '--output', help="output file (default: stdout)")
+    args = ap.parse_args()
+
+    # the display pointer is only copied, never dereferenced
+    dpy = xlib.cast(xlib.c_void_p(1), xlib.POINTER(xlib.Display))
+    rng = random.Random(args.seed)
+
+    results = {'version': VERSION,
+               'python': platform.python_version(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'events': args.events,
+               'scenarios': {}}
+    for name, types in sorted(EVENT_TYPES.items()):
+        events = wire_events(rng, types, args.events)
+        check(dpy, events)
+        decoder = xlib.WireDecoder(dpy)
+        generic = measure(lambda data: xlib.XWireToEvent(dpy, data), events, args.repeat)
+        fast = measure(decoder.decode, events, args.repeat)
+        results['scenarios'][name] = {'XWireToEvent_us': generic * 1e6,
+                                      'WireDecoder_us': fast * 1e6,
+                                      'speedup': generic / fast}
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+# Copyright(c) 2015-2016: wave++ "Yuri D'Elia" <wavexx@thregr.org>.
+#
+# End-to-end latency benchmark: a private Xvfb server is started, keys are
+# injected through XTest at a controlled rate, and the time until each key
+# reaches LabelManager (and the label callback) is measured. Keys cycle
+# through the alphabet, so that dropped and reordered events can be detected.
+# With --compare-relay each rate is run with the server relay (the baseline)
+# and the local relay, and their latencies are compared. Results are written
+# as JSON.
+
+from __future__ import print_function, unicode_literals, division
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Screenkey import Options, CAPTURE_BACKENDS, COMPOSE_ENGINES, LOOP_MODES, RELAY_MODES, \
+    TRANSLATORS, xlib
+from Screenkey.labelmanager import LabelManager
+from Screenkey.timer import monotonic
+
+if sys.version_info.major < 3:
+    import glib
+else:
+    from gi.repository import GLib as glib
+
+from argparse import ArgumentParser
+import json
+import logging
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+class FakePangoContext(object):
+    def list_families(self):
+        return []
+
+
+def start_xvfb(args):
+    for num in range(args.display, args.display + 100):
+        if not os.path.exists('/tmp/.X11-unix/X{}'.format(num)) and \
+           not os.path.exists('/tmp/.X{}-lock'.format(num)):
+            break
+    else:
+        raise RuntimeError("no free display number")
+    display = ':{}'.format(num)
+    proc = subprocess.Popen(['Xvfb', display, '-screen', '0', '1280x720x24',
+                             '-nolisten', 'tcp'],
+                            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    for i in range(100):
+        if os.path.exists('/tmp/.X11-unix/X{}'.format(num)):
+            break
+        if proc.poll() is not None:
+            raise RuntimeError("Xvfb failed to start")
+        time.sleep(0.05)
+    else:
+        proc.kill()
+        raise RuntimeError("timeout while waiting for Xvfb")
+    return proc, display
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    def pct(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))] * 1e3
+    return {'count': len(samples),
+            'mean_ms': sum(samples) / len(samples) * 1e3,
+            'p50_ms': pct(0.50),
+            'p90_ms': pct(0.90),
+            'p99_ms': pct(0.99),
+            'max_ms': samples[-1] * 1e3}
+
+
+class Injector(threading.Thread):
+    def __init__(self, display, rate, count):
+        super(Injector, self).__init__()
+        self.daemon = True
+        self.rate = rate
+        self.count = count
+        self.stamps = []
+        self.dpy = xlib.XOpenDisplay(display.encode('ascii'))
+        if not self.dpy:
+            raise RuntimeError("cannot open display {}".format(display))
+        ev, err, major, minor = [xlib.c_int() for i in range(4)]
+        if not xlib.XTestQueryExtension(self.dpy, *map(xlib.byref, [ev, err, major, minor])):
+            raise RuntimeError("XTest extension not available")
+        self.keycodes = []
+        for c in LETTERS:
+            keysym = xlib.XStringToKeysym(c.encode('ascii'))
+            self.keycodes.append(xlib.XKeysymToKeycode(self.dpy, keysym))
+
+
+    def run(self):
+        start = monotonic()
+        for i in range(self.count):
+            delay = start + i / self.rate - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            keycode = self.keycodes[i % len(self.keycodes)]
+            self.stamps.append(monotonic())
+            xlib.XTestFakeKeyEvent(self.dpy, keycode, True, 0)
+            xlib.XTestFakeKeyEvent(self.dpy, keycode, False, 0)
+            xlib.XFlush(self.dpy)
+
+
+    def close(self):
+        xlib.XCloseDisplay(self.dpy)
+
+
+
+class Probe(object):
+    def __init__(self, injector):
+        self.injector = injector
+        self.next = 0
+        self.last = None
+        self.dropped = 0
+        self.reordered = 0
+        self.backlog = 0
+        self.key_latency = []
+        self.label_latency = []
+        self.progress = monotonic()
+
+
+    def key_hook(self, func):
+        def wrapper(event):
+            if event.pressed:
+                self.on_key(event)
+            return func(event)
+        return wrapper
+
+
+    def label_hook(self, func):
+        def wrapper(label):
+            if self.last is not None:
+                now = monotonic()
+                self.label_latency.append(now - self.injector.stamps[self.last])
+            return func(label)
+        return wrapper
+
+
+    def on_key(self, event):
+        now = monotonic()
+        self.progress = now
+        injected = len(self.injector.stamps)
+        # the alphabet has no repetitions within its length
+        for i in range(self.next, min(self.next + len(LETTERS), injected)):
+            if LETTERS[i % len(LETTERS)] == event.symbol:
+                self.dropped += i - self.next
+                self.key_latency.append(now - self.injector.stamps[i])
+                self.backlog = max(self.backlog, injected - i - 1)
+                self.last = i
+                self.next = i + 1
+                return
+        self.reordered += 1
+
+
+
+def run_rate(rate, args, display, relay):
+    injector = Injector(display, rate, args.count)
+    probe = Probe(injector)
+    logger = logging.getLogger('bench')
+
+    if args.window:
+        from Screenkey.screenkey import Screenkey
+        options = Options({'no_systray': True,
+                           'key_mode': args.key_mode,
+                           'compose_engine': args.compose_engine,
+                           'translator': args.translator,
+                           'relay': relay,
+                           'capture': args.capture,
+                           'loop': args.loop,
+                           'timeout': 1.0})
+        app = Screenkey(logger=logger, options=options)
+        lm = app.labelmngr
+        lm.listener = probe.label_hook(app.on_label_change)
+    else:
+        app = None
+        lm = LabelManager(probe.label_hook(lambda label: None), logger,
+                          key_mode=args.key_mode, bak_mode='baked', mods_mode='normal',
+                          mods_only=False, multiline=False, vis_shift=False,
+                          vis_space=True, recent_thr=0.1, compr_cnt=3, ignore=[],
+                          pango_ctx=FakePangoContext(), compose_engine=args.compose_engine,
+                          translator=args.translator, relay=relay,
+                          capture=args.capture, loop=args.loop)
+        lm.start()
+    lm.key_process = probe.key_hook(lm.key_process)
+
+    # let the listener settle before injecting
+    ctx = glib.main_context_default()
+    deadline = monotonic() + 0.5
+    while monotonic() < deadline:
+        ctx.iteration(False)
+        time.sleep(0.001)
+
+    injector.start()
+    while injector.is_alive() or \
+          (probe.next < args.count and monotonic() - probe.progress < args.settle):
+        if not ctx.iteration(False):
+            time.sleep(0.0005)
+    injector.join()
+
+    # gtk.main() is not running: tear the window down without Screenkey.quit
+    lm.stop()
+    if app is not None:
+        app.timer_hide.cancel()
+        app.timer_min.cancel()
+        app.destroy()
+    injector.close()
+
+    # latency of the last key: grows when the pipeline cannot keep up
+    drain = probe.key_latency[-1] if probe.next == args.count else None
+    lost = args.count - probe.next
+    return {'rate': rate,
+            'relay': relay,
+            'injected': len(injector.stamps),
+            'received': len(probe.key_latency),
+            'dropped': probe.dropped + lost,
+            'reordered': probe.reordered,
+            'max_backlog': probe.backlog,
+            'drain_ms': drain * 1e3 if drain is not None else None,
+            'key_press': percentiles(probe.key_latency),
+            'label_change': percentiles(probe.label_latency)}
+
+
+def sustainable(result, args):
+    return result['dropped'] == 0 and result['reordered'] == 0 and \
+        result['drain_ms'] is not None and result['drain_ms'] <= args.max_lag
+
+
+def compare_relay(results):
+    # latency of the local relay relative to the server relay (baseline)
+    ret = []
+    runs = {(r['rate'], r['relay']): r for r in results}
+    for rate in sorted(set(r['rate'] for r in results)):
+        base, local = runs[(rate, 'server')], runs[(rate, 'local')]
+        cmp = {'rate': rate}
+        for stage in ['key_press', 'label_change']:
+            for p in ['p50_ms', 'p99_ms']:
+                if p in base[stage] and p in local[stage]:
+                    cmp['{}_{}_delta'.format(stage, p)] = local[stage][p] - base[stage][p]
+        ret.append(cmp)
+    return ret
+
+
+def main():
+    ap = ArgumentParser(description="End-to-end latency benchmark on Xvfb")
+    ap.add_argument('-r', '--rates', default='20,50,100,200,500,1000,2000',
+                    help="comma-separated list of injection rates (keys/s)")
+    ap.add_argument('-n', '--count', type=int, default=500,
+                    help="keys injected for each rate")
+    ap.add_argument('--key-mode', default='composed',
+                    help="keyboard mode of the listener")
+    ap.add_argument('--compose-engine', choices=COMPOSE_ENGINES, default='xim',
+                    help="compose engine of the listener")
+    ap.add_argument('--translator', choices=TRANSLATORS, default='xlib',
+                    help="translator of the listener")
+    ap.add_argument('--relay', choices=RELAY_MODES, default='server',
+                    help="relay mode of the listener")
+    ap.add_argument('--compare-relay', action='store_true',
+                    help="run each rate with both relay modes and compare them")
+    ap.add_argument('--capture', choices=CAPTURE_BACKENDS, default='record',
+                    help="capture backend of the listener")
+    ap.add_argument('--loop', choices=LOOP_MODES, default='thread',
+                    help="event loop of the listener")
+    ap.add_argument('--window', action='store_true',
+                    help="run the full Screenkey window (requires PyGTK)")
+    ap.add_argument('--max-lag', type=float, default=50.,
+                    help="maximum latency of the last key for a rate to be sustainable (ms)")
+    ap.add_argument('--settle', type=float, default=2.,
+                    help="time to wait for outstanding keys (s)")
+    ap.add_argument('--display', type=int, default=90,
+                    help="first display number to try")
+    ap.add_argument('-o', '--output', help="output file (default: stdout)")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    xvfb, display = start_xvfb(args)
+    os.environ['DISPLAY'] = display
+
+    # keep the benchmark away from the stored settings
+    config = tempfile.mkdtemp()
+    os.environ['XDG_CONFIG_HOME'] = config
+
+    glib.threads_init()
+    results = {'python': platform.python_version(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'key_mode': args.key_mode,
+               'compose_engine': args.compose_engine,
+               'translator': args.translator,
+               'relay': 'compare' if args.compare_relay else args.relay,
+               'capture': args.capture,
+               'loop': args.loop,
+               'window': args.window,
+               'count': args.count,
+               'rates': []}
+    relays = ['server', 'local'] if args.compare_relay else [args.relay]
+    try:
+        for rate in [float(x) for x in args.rates.split(',')]:
+            for relay in relays:
+                print("injecting at {} keys/s ({} relay)...".format(rate, relay),
+                      file=sys.stderr)
+                result = run_rate(rate, args, display, relay)
+                result['sustainable'] = sustainable(result, args)
+                results['rates'].append(result)
+    finally:
+        xvfb.terminate()
+        xvfb.wait()
+        shutil.rmtree(config, ignore_errors=True)
+
+    for relay in relays:
+        rates = [r['rate'] for r in results['rates'] if r['relay'] == relay and r['sustainable']]
+        key = 'max_sustainable_rate_' + relay if args.compare_relay else 'max_sustainable_rate'
+        results[key] = max(rates) if rates else None
+    if args.compare_relay:
+        results['relay_comparison'] = compare_relay(results['rates'])
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()